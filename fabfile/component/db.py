@@ -29,14 +29,177 @@
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
 
-from fabric.colors import yellow
+import atexit
+import datetime
+import os.path
+from pipes import quote
+import re
+import socket
+import subprocess
+import time
+
+from fabric.colors import yellow, red, blue, green
 from fabric.context_managers import settings, warn_only
 from fabric.decorators import task, roles
 from fabric.operations import run, sudo
 from fabric.tasks import execute
 from fabric.api import env
 from fabtools import require
-from fabfile.utils import  get_psql_version, _upload_template
+from fabfile.utils import (get_bool_from_cli, get_psql_version, get_host_resources, get_db_pool_context,
+                           get_tyr_worker_resources, exec_command, run_once_per_role, Parallel, _render_template, _upload_template)
+from fabfile.component import pgbouncer
+psycopg2_loaded = False
+try:
+    import psycopg2.pool
+    psycopg2_loaded = True
+except ImportError:
+    pass
+
+# the pool of connections to the jormungandr database and its ssh tunnel, see _connection_pool
+_pool = None
+_tunnel = None
+
+
+def _psql_command(sql, database, host=None, user=None, password=None):
+    """Return the shell command streaming sql to psql, see psql"""
+    if host:
+        command = 'PGPASSWORD={} psql -h {} -U {}'.format(quote(password), host, user)
+    else:
+        command = 'sudo -i -u postgres psql'
+    return "{} -X -A -t -q -v ON_ERROR_STOP=1 {} <<'EOSQL'\n{}\nEOSQL".format(command, database, sql)
+
+
+def _parse_psql_output(output):
+    """Return the rows of the unaligned output of psql, see psql"""
+    return [[value or None for value in line.rstrip('\r').split('|')]
+            for line in output.split('\n') if line.strip()]
+
+
+def psql(sql, database='postgres', host=None, user=None, password=None, **kwargs):
+    """Run sql, one or several statements, with a single psql execution, the sql
+        being streamed to psql through its stdin
+        psql is run as postgres on the current host, or connects to host as user
+        if host is given; the other kwargs are given to run (ex: quiet=True)
+        Return the rows output by the statements, as lists of strings, None for
+        the NULL (or empty) values; the callers convert the other types
+    """
+    output = run(_psql_command(sql, database, host, user, password), **kwargs)
+    if output.failed:
+        return []
+    return _parse_psql_output(output)
+
+
+def psql_from_thread(from_host, sql, database, host, user, password):
+    """Same as psql, run from from_host without changing the fabric env (see
+        utils.exec_command), so that it can be called from a thread while other
+        tasks are running
+        Return None if psql failed
+    """
+    status, output = exec_command(from_host, _psql_command(sql, database, host, user, password))
+    return _parse_psql_output(output) if status == 0 else None
+
+
+def _literal(value):
+    """Return the sql literal of a value, as psycopg2 would adapt it, as an utf-8 str"""
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, long, float)):
+        return str(value)
+    if isinstance(value, (list, tuple)):
+        return '({})'.format(', '.join(_literal(v) for v in value))
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    return u"'{}'".format(unicode(value).replace(u"'", u"''")).encode('utf-8')
+
+
+def _connection_pool():
+    """Return the pool of connections to the jormungandr database
+        The connections go through an ssh tunnel to the db host opened once per
+        run if env.db_pool_tunnel, else directly to env.postgresql_database_host
+        (ex: for a local PostgreSQL)
+    """
+    global _pool, _tunnel
+    if _pool is None:
+        if not psycopg2_loaded:
+            print(red("CRITICAL: Can't use a connection pool as 'import psycopg2' fails"))
+            exit(1)
+        host, port = env.postgresql_database_host, env.postgresql_database_port
+        if env.db_pool_tunnel:
+            # ask the system for a free local port
+            sock = socket.socket()
+            sock.bind(('localhost', 0))
+            local_port = sock.getsockname()[1]
+            sock.close()
+            command = ['ssh', '-N', '-o', 'BatchMode=yes', '-o', 'ExitOnForwardFailure=yes',
+                       '-L', '{}:{}:{}'.format(local_port, host, port)]
+            for key in ([env.key_filename] if isinstance(env.key_filename, basestring) else env.key_filename or []):
+                command += ['-i', key]
+            _tunnel = subprocess.Popen(command + [env.roledefs['db'][0]])
+            atexit.register(close_connection_pool)
+            for _ in range(50):
+                if _tunnel.poll() is not None:
+                    print(red("CRITICAL: can't open the ssh tunnel to {}".format(env.roledefs['db'][0])))
+                    exit(1)
+                try:
+                    socket.create_connection(('localhost', local_port), 1).close()
+                    break
+                except socket.error:
+                    time.sleep(0.2)
+            host, port = 'localhost', local_port
+        _pool = psycopg2.pool.ThreadedConnectionPool(1, env.db_pool_size, host=host, port=port,
+                                                     dbname=env.jormungandr_postgresql_database,
+                                                     user=env.tyr_postgresql_user,
+                                                     password=env.tyr_postgresql_password)
+    return _pool
+
+
+def close_connection_pool():
+    """Close the connections of the pool and its ssh tunnel"""
+    global _pool, _tunnel
+    if _pool is not None:
+        _pool.closeall()
+        _pool = None
+    if _tunnel is not None:
+        _tunnel.terminate()
+        _tunnel.wait()
+        _tunnel = None
+
+
+def _psql_value(value):
+    """Return a value read by psycopg2 as psql would output it, see psql"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value if isinstance(value, str) else str(value)
+
+
+def jormungandr_query(sql, params=None):
+    """Run a statement with psycopg2 style named parameters (%(name)s) on the
+        jormungandr database and return its rows
+        With env.use_db_connection_pool, the statement is run locally with a
+        pooled connection, else the parameters are inlined and it is run with psql
+        on the current host
+        Either way, the rows are returned as psql returns them: lists of strings,
+        None for the NULL (or empty) values
+    """
+    if not env.use_db_connection_pool:
+        return psql(sql % dict((k, _literal(v)) for k, v in (params or {}).items()) if params else sql,
+                    env.jormungandr_postgresql_database)
+    pool = _connection_pool()
+    connection = pool.getconn()
+    try:
+        # commit on success, rollback on error
+        with connection:
+            cursor = connection.cursor()
+            cursor.execute(sql, params)
+            return [[_psql_value(v) for v in row] for row in cursor.fetchall()] if cursor.description else []
+    finally:
+        pool.putconn(connection)
 
 
 def instance2postgresql_name(instance):
@@ -64,6 +227,133 @@ def setup_db():
     require.postgres.user(env.tyr_postgresql_user, env.tyr_postgresql_password)
     require.postgres.database(env.tyr_postgresql_database, owner=env.tyr_postgresql_user, locale='en_US.UTF-8')
     postgis_initdb(env.tyr_postgresql_database)
+    require_ed_template()
+
+def get_postgresql_tuning():
+    """Return the PostgreSQL settings derived from the RAM and cores of the host,
+        overridden by env.postgresql_tuning, as a sorted list of (name, value)
+    """
+    resources = get_host_resources()
+    mem_mb = resources['mem_total_kb'] // 1024
+    max_connections = int(psql("SHOW max_connections;")[0][0])
+    version = [int(v) for v in get_psql_version()[0:2]]
+    shared_buffers = min(mem_mb // 4, 8192)
+    tuning = {
+        'shared_buffers': '{}MB'.format(shared_buffers),
+        'effective_cache_size': '{}MB'.format(mem_mb * 3 // 4),
+        # bulk loads of the binarizations and index creations
+        'maintenance_work_mem': '{}MB'.format(min(mem_mb // 16, 2048)),
+        # a few sorts or hashes by query on each connection
+        'work_mem': '{}MB'.format(max(4, min(256, (mem_mb - shared_buffers) // (max_connections * 3)))),
+        'wal_buffers': '16MB',
+        'checkpoint_timeout': '15min',
+        'checkpoint_completion_target': 0.9,
+    }
+    if version >= [9, 5]:
+        tuning['max_wal_size'] = '4GB'
+        tuning['min_wal_size'] = '1GB'
+    else:
+        tuning['checkpoint_segments'] = 64
+    tuning.update(env.postgresql_tuning)
+    return mem_mb, resources['cores'], sorted(tuning.items())
+
+
+def _pgbench():
+    """Return the tps of a pgbench run on the bench database"""
+    if not is_postgresql_database_exist(env.postgresql_bench_database):
+        psql('CREATE DATABASE "{}";'.format(env.postgresql_bench_database))
+        run('sudo -i -u postgres pgbench -i -q -s {} {}'.format(env.postgresql_bench_scale,
+                                                             env.postgresql_bench_database))
+    cores = get_host_resources()['cores']
+    output = run('sudo -i -u postgres pgbench -c {c} -j {c} -T {t} {db}'.format(
+        c=cores, t=env.postgresql_bench_duration, db=env.postgresql_bench_database))
+    match = re.search(r"tps = ([\d.]+)", output)
+    return float(match.group(1)) if match else None
+
+
+@task
+@roles('db')
+def tune_db(apply=True, bench=False, restart=False):
+    """Tune PostgreSQL for the RAM and cores of the host, with a managed file
+        included by postgresql.conf
+        The diff with the current tuning is printed, then unless not apply the
+        file is installed and the configuration reloaded; shared_buffers and
+        wal_buffers are only taken into account at the next restart (restart=True)
+        If bench, the tps of a pgbench run is compared before and after
+    """
+    apply, bench, restart = get_bool_from_cli(apply), get_bool_from_cli(bench), get_bool_from_cli(restart)
+    mem_mb, cores, tuning = get_postgresql_tuning()
+    config_dir = os.path.dirname(psql("SHOW config_file;")[0][0])
+    tuning_file = os.path.join(config_dir, 'conf.d', 'fabric_navitia.conf')
+
+    run('mkdir -p {}/conf.d'.format(config_dir))
+    _upload_template("db/postgresql_tuning.conf.jinja", tuning_file + '.new', user='postgres',
+                     context={'mem_mb': mem_mb, 'cores': cores, 'settings': tuning})
+    run('diff -u -N {f} {f}.new; true'.format(f=tuning_file))
+    if not apply:
+        run('rm -f {}.new'.format(tuning_file))
+        return
+
+    before = _pgbench() if bench else None
+    run('mv {f}.new {f}'.format(f=tuning_file))
+    run("grep -q \"^include 'conf.d/fabric_navitia.conf'\" {f} || "
+        "echo \"include 'conf.d/fabric_navitia.conf'\" >> {f}".format(f=os.path.join(config_dir, 'postgresql.conf')))
+    if restart:
+        sudo('service postgresql restart')
+    else:
+        psql("SELECT pg_reload_conf();")
+        print(yellow("WARNING: shared_buffers and wal_buffers need a restart of PostgreSQL (tune_db:restart=True)"))
+    if bench:
+        after = _pgbench()
+        print(blue("pgbench: {} tps before, {} tps after".format(before, after)))
+
+
+@task
+@roles('db')
+@run_once_per_role
+def check_db_connections(strict=True):
+    """Check that PostgreSQL accepts the connections of all the SQLAlchemy pools
+        of jormungandr and tyr (each tyr worker process counting for one), or of
+        all the pgbouncer pools with env.use_pgbouncer
+        Abort if it may not, unless not strict (when deploying the configurations)
+        where it is only a warning
+    """
+    max_connections, reserved = [int(row[0]) for row in
+                                 psql("SHOW max_connections;\nSHOW superuser_reserved_connections;")]
+    needed = {}
+    if env.use_pgbouncer:
+        # pgbouncer opens up to default_pool_size + reserve_pool_size connections by
+        # database and user, within max_db_connections and max_user_connections
+        by_pool = env.pgbouncer_default_pool_size + env.pgbouncer_reserve_pool_size
+        by_database, by_user = {}, {}
+        for database, user in pgbouncer.get_server_pools():
+            by_database[database] = by_database.get(database, 0) + by_pool
+            by_user[user] = by_user.get(user, 0) + by_pool
+        by_host = min(sum(min(n, env.pgbouncer_max_db_connections or n) for n in by_database.values()),
+                      sum(min(n, env.pgbouncer_max_user_connections or n) for n in by_user.values()))
+        nb_hosts = len(pgbouncer.get_pgbouncer_hosts()) if env.pgbouncer_colocated else 1
+        needed['pgbouncer'] = nb_hosts * by_host
+    else:
+        for component, hosts in (('jormungandr', env.roledefs['ws']), ('tyr', env.roledefs['tyr'])):
+            pool = get_db_pool_context(component)
+            needed[component] = len(hosts) * env[component + '_wsgi_processes'] * \
+                (pool['db_pool_size'] + pool['db_max_overflow'])
+        # each process of the tyr workers holds a connection, their concurrency is fitted to each host
+        needed['tyr workers'] = sum(r['tyr_worker_concurrency'] for r in
+                                    execute(get_tyr_worker_resources, hosts=env.roledefs['tyr']).values())
+    total = sum(needed.values())
+    detail = ', '.join('{} {}'.format(n, c) for c, n in sorted(needed.items()))
+    if total > max_connections - reserved:
+        message = "the connection pools need up to {} connections ({}) but PostgreSQL accepts {}, " \
+                  "raise max_connections or lower the pools".format(total, detail, max_connections - reserved)
+        if get_bool_from_cli(strict):
+            print(red("CRITICAL: " + message))
+            exit(1)
+        print(yellow("WARNING: " + message))
+        return
+    print(blue("connection pools: up to {} connections ({}) for {} accepted".format(
+        total, detail, max_connections - reserved)))
+
 
 @task
 @roles('db')
@@ -79,17 +369,16 @@ def postgis_initdb(instance_db):
     # # init_db.sh, create this on database host because sql scripts or @localhost
     # # and must be run as postgres user
 
-    psql_version = get_psql_version()
-    if psql_version[0:2] == ["9", "1"]:
+    psql_version = [int(v) for v in get_psql_version()[0:2]]
+    if psql_version == [9, 1]:
         postgis_path = '/usr/share/postgresql/9.1/contrib/postgis-1.5'
         with settings(sudo_user='postgres'):
             sudo('psql --set ON_ERROR_STOP=1 --dbname={} '
                  '--file {}/postgis.sql'.format(instance_db, postgis_path))
             sudo('psql --set ON_ERROR_STOP=1 --dbname={}'
                 ' --file {}/spatial_ref_sys.sql'.format(instance_db, postgis_path))
-    elif psql_version[0:2] >= ["9", "3"]:
-        with settings(sudo_user='postgres'):
-            sudo('psql -c "CREATE EXTENSION  IF NOT EXISTS postgis;" --dbname={}'.format(instance_db))
+    elif psql_version >= [9, 3]:
+        psql("CREATE EXTENSION IF NOT EXISTS postgis;", instance_db)
     else:
         raise EnvironmentError("Bad version of postgres")
 
@@ -97,56 +386,23 @@ def postgis_initdb(instance_db):
 @roles('db')
 def set_tyr_is_free(instance, is_free=True):
     """Set is_free flag in jormungandr database for a given instance"""
-
-    _upload_template("db/is-free.sql.jinja", \
-            "/var/lib/postgresql/postgres_{}.sql".format(instance),
-            context={
-                'instance': instance,
-                'is_free': is_free,
-            }
-    )
-    run('su - postgres --command="psql {} < /var/lib/postgresql/postgres_{}.sql"'
-            .format(env.jormungandr_postgresql_database, instance))
-    run("rm -f /var/lib/postgresql/postgres_{}.sql".format(instance))
+    jormungandr_query(_render_template("db/is-free.sql.jinja"), {'instance': instance, 'is_free': is_free})
 
 @task
 @roles('db')
 def check_is_postgresql_user_exist(username):
     """Check if a given postgresql user exist"""
-    _upload_template("db/check_is_postgresql_user_exist.sql.jinja",
-            "/var/lib/postgresql/postgres_{}.sql".format(username),
-            context={
-                'username': username,
-            }
-    )
-    user = run('su - postgres --command="psql --tuples-only postgres < /var/lib/postgresql/postgres_{}.sql"'
-               .format(username))
-    run("rm -f /var/lib/postgresql/postgres_{}.sql".format(username))
-    if username == user:
-        return True
-    else:
-        return False
+    return bool(psql(_render_template("db/check_is_postgresql_user_exist.sql.jinja", {'username': username})))
 
 @task
 @roles('db')
 def create_postgresql_user(username, password):
     """ Create a postgresql user"""
-    run('su - postgres --command="createuser {} --no-createdb --no-createrole --no-superuser"'.format(username))
-
-    # set the password
-    _upload_template("db/set_user_password.sql.jinja",
-            "/var/lib/postgresql/postgres_{}.sql".format(username),
-            context={
-                'username': username,
-                'password': password,
-            }
-    )
-    run('su - postgres --command="psql postgres < /var/lib/postgresql/postgres_{}.sql"'.format(username))
-    run("rm -f /var/lib/postgresql/postgres_{}.sql".format(username))
+    psql('CREATE USER "{}" NOCREATEDB NOCREATEROLE NOSUPERUSER;\n'.format(username) +
+         _render_template("db/set_user_password.sql.jinja", {'username': username, 'password': _literal(password)}))
 
     # test the user access
-    run('PGPASSWORD="{}" psql --tuples-only --host localhost --username {} '
-        'postgres --command="SELECT * FROM pg_catalog.pg_database;"'.format(password, username))
+    psql("SELECT * FROM pg_catalog.pg_database;", host='localhost', user=username, password=password)
 
 @task
 @roles('db')
@@ -157,56 +413,39 @@ def create_postgresql_database(database, username=None):
     if not username:
         username = database
 
-    run('su - postgres --command="createdb {database} --owner={username} --encoding=UTF8"'
-            .format(database=database, username=username))
+    psql('CREATE DATABASE "{}" OWNER "{}" ENCODING \'UTF8\';'.format(database, username))
 
 @task
 @roles('db')
 def rename_postgresql_database(current_database, new_database):
     """ Rename a postgresql database and the SAME corresponding username"""
-
-    _upload_template("db/rename_postgresql_database_user.sql.jinja",
-            "/var/lib/postgresql/postgres_{}.sql".format(current_database),
-            context={
-                'current_database': current_database,
-                'new_database': new_database,
-            }
-    )
-    run('su - postgres --command="psql postgres < /var/lib/postgresql/postgres_{}.sql"'.format(current_database))
-    run("rm -f /var/lib/postgresql/postgres_{}.sql".format(current_database))
+    psql(_render_template("db/rename_postgresql_database_user.sql.jinja",
+                          {'current_database': current_database, 'new_database': new_database}))
 
 @task
 @roles('db')
 def remove_postgresql_database(database):
     """Remove a postgresql database"""
-    run('su - postgres --command="dropdb {database}"'
-            .format(database=database))
+    psql('DROP DATABASE "{}";'.format(database))
 
 @task
 @roles('db')
 def remove_postgresql_user(username):
     """ Create a postgresql user"""
-    run('su - postgres --command="dropuser {}"'.format(username))
+    psql('DROP USER "{}";'.format(username))
 
 @roles('db')
 def is_postgresql_user_exist(username):
-#   select exists (SELECT * FROM pg_user WHERE usename=\'ed_uk\');
-    dbuserexist = run('sudo -i -u postgres psql -A -t -c "select exists (SELECT * FROM pg_user WHERE usename=\'{}\');"'
-                      .format(username))
-    return dbuserexist == 't'
+    return psql("SELECT exists (SELECT * FROM pg_user WHERE usename='{}');".format(username)) == [['t']]
 
 @roles('db')
 def is_postgresql_database_exist(dbname):
-    dbnameexist = run('sudo -i -u postgres psql -A -t -c "select exists (SELECT * FROM pg_database '
-                      'WHERE datname=\'{}\');"'.format(dbname))
-    return dbnameexist == 't'
+    return psql("SELECT exists (SELECT * FROM pg_database WHERE datname='{}');".format(dbname)) == [['t']]
 
 
 @roles('db')
 def db_has_postgis(dbname):
-    res = run('sudo -i -u postgres psql -A -t -c '
-              '"select exists (select 1 from pg_type where typname = \'geography\');" {}'.format(dbname))
-    return res == 't'
+    return psql("SELECT exists (SELECT 1 FROM pg_type WHERE typname = 'geography');", dbname) == [['t']]
 
 
 @task
@@ -215,31 +454,16 @@ def remove_instance_from_jormun_database(instance):
     """Remove a given ed instance in jormungandr PostgreSQL db
         http://jira.canaltp.fr/browse/NAVITIAII-1098
     """
-    _upload_template("db/remove_instance.sql.jinja", \
-            "/var/lib/postgresql/postgres_{}.sql".format(instance),
-            context={
-                'instance': instance,
-            }
-    )
-    run('su - postgres --command="psql jormungandr < /var/lib/postgresql/postgres_{}.sql"'.format(instance))
-    run("rm -f /var/lib/postgresql/postgres_{}.sql".format(instance))
+    jormungandr_query(_render_template("db/remove_instance.sql.jinja"), {'instance': instance})
 
 
 @task
 @roles('db')
 def rename_tyr_jormungandr_database(current_instance, new_instance):
     """ Rename the instance id in the jormungandr database """
-
-    _upload_template("db/rename_tyr_jormungandr_database.sql.jinja", \
-            "/var/lib/postgresql/postgres_{}.sql".format(current_instance),
-            context={
-                'current_database': current_instance,
-                'new_database': new_instance,
-            }
-    )
-    run('su - postgres --command="psql {} < /var/lib/postgresql/postgres_{}.sql"'
-            .format(env.jormungandr_postgresql_database, current_instance))
-    run("rm -f /var/lib/postgresql/postgres_{}.sql".format(current_instance))
+    psql(_render_template("db/rename_tyr_jormungandr_database.sql.jinja",
+                          {'current_instance': current_instance, 'new_instance': new_instance}),
+         env.jormungandr_postgresql_database)
 
 
 @task
@@ -252,26 +476,245 @@ def call_tyr_http_authorization(uid, instance_id):
 @task
 @roles('db')
 def set_instance_authorization(instance):
-    # Utilisation de "sudo -u" pour la gestion des simples cote '' apres le "where"
-    # Utilisation du parametre "-i" de sudo pour eviter la redirection 'could not change directory to "/root"'
-    # Utilisation du parametre "-A" de psql pour suprimer la ligne dans le resultat de la requete sql
-    # Utilisation de parametre "-t" de psql pour afficher uniquement le resultat du "select"
-    instance_id = run('sudo -i -u postgres psql -A -t --dbname={} '
-                      '-c "select id from instance where name = \'{}\';"'
-                      .format(env.jormungandr_postgresql_database, instance))
-    uid = run('sudo -i -u postgres psql -A -t --dbname={} -c "select user_id from key '
-              'where token = \'{}\';"'.format(env.jormungandr_postgresql_database, env.token))
-    if instance_id.isdigit() and uid.isdigit():
+    # the instance id and the user of the admin token in one query
+    instance_id, uid = jormungandr_query("SELECT (SELECT id FROM instance WHERE name = %(instance)s), "
+                                         "(SELECT user_id FROM key WHERE token = %(token)s);",
+                                         {'instance': instance, 'token': env.token})[0]
+    if instance_id is not None and uid is not None:
         execute(call_tyr_http_authorization, uid, instance_id)
     else:
         print(yellow("WARNING: Le token d'administration n'a pas été appliqué sur l'instance!!!"))
 
 @task
 @roles('db')
-def create_instance_db(instance):
-    
-    postgresql_user = instance.db_user
-    postgresql_database = instance.db_name
+def get_last_done_data_sets():
+    """ Return for each instance the names of its last done data_set of each type """
+    data_sets = {}
+    for instance, data_set in jormungandr_query("SELECT DISTINCT ON (instance.name, data_set.family_type) "
+                                                "instance.name, data_set.name FROM instance, job, data_set "
+                                                "WHERE instance.id = job.instance_id AND job.id = data_set.job_id "
+                                                "AND job.state = 'done' "
+                                                "ORDER BY instance.name, data_set.family_type, job.created_at DESC;"):
+        data_sets.setdefault(instance, []).append(data_set)
+    return data_sets
+
+# indexes supporting the job/data_set queries of the tool on the jormungandr
+# database, prefixed to stay apart from the ones of the tyr migrations
+JOB_INDEXES = [
+    ('fabric_job_instance_id_state_created_at', 'job', 'instance_id, state, created_at'),
+    ('fabric_data_set_job_id', 'data_set', 'job_id'),
+]
+
+
+def _explain_job_queries():
+    """Return for each job/data_set query of the tool its execution time in ms
+        and whether its plan has a sequential scan of job or data_set
+    """
+    # the instance with the most jobs as the worst case
+    biggest = "(SELECT instance_id FROM job GROUP BY instance_id ORDER BY count(*) DESC LIMIT 1)"
+    queries = [
+        ('last datasets', _render_template("db/last-datasets.sql.jinja") % {
+            'instances': _literal(tuple(env.instances.keys()) or ('',)),
+            'pending_since': _literal((datetime.date.today() - datetime.timedelta(days=10)).isoformat())}),
+        ('last pt data_set', _render_template("db/job-id-data-set.sql.jinja") % {'instance_id': biggest}),
+        ('last done job', _render_template("db/last-job-instance.sql.jinja") % {'instance_id': biggest}),
+    ]
+    rows = psql("\n".join("SELECT 'query:{}';\nEXPLAIN ANALYZE {}".format(name, sql) for name, sql in queries),
+                env.jormungandr_postgresql_database)
+    plans = {}
+    for row in rows:
+        line = str(row[0])
+        if line.startswith('query:'):
+            plan = plans[line[len('query:'):]] = {'time': None, 'seq_scan': False}
+            continue
+        # 'Execution time' since 9.4, 'Total runtime' before
+        match = re.search(r"(?:Execution time|Total runtime): ([\d.]+) ms", line)
+        if match:
+            plan['time'] = float(match.group(1))
+        if re.search(r"Seq Scan on (job|data_set)\b", line):
+            plan['seq_scan'] = True
+    return plans
+
+
+@task
+@roles('db')
+def ensure_job_indexes(apply=True):
+    """Check the plans of the job/data_set queries of the tool and create
+        concurrently the supporting indexes which are missing (see JOB_INDEXES),
+        then print the execution times before and after
+        With apply=False, only print the plans and the missing indexes
+    """
+    existing = psql("SELECT tablename, indexname, indexdef FROM pg_indexes WHERE tablename IN ('job', 'data_set');",
+                    env.jormungandr_postgresql_database)
+    # an index on the same leading columns is as good as ours
+    missing = [(name, table, columns) for name, table, columns in JOB_INDEXES
+               if not any(t == table and (n == name or '({}'.format(columns) in d) for t, n, d in existing)]
+    before = _explain_job_queries()
+    if missing and get_bool_from_cli(apply):
+        for name, table, columns in missing:
+            print(blue("creating index {} on {} ({})".format(name, table, columns)))
+        # one transaction by statement, as required by CONCURRENTLY, the tables are not locked
+        psql("\n".join("CREATE INDEX CONCURRENTLY {} ON {} ({});".format(*index) for index in missing) +
+             "\nANALYZE job;\nANALYZE data_set;", env.jormungandr_postgresql_database)
+        after = _explain_job_queries()
+    else:
+        after = {}
+        for name, table, columns in missing:
+            print(yellow("missing index {} on {} ({})".format(name, table, columns)))
+
+    for query, plan in sorted(before.items()):
+        print(blue("{}: {} ms{}{}".format(
+            query, plan['time'], ' (sequential scan)' if plan['seq_scan'] else '',
+            " -> {} ms".format(after[query]['time']) if query in after else '')))
+
+
+def vacuum_database(from_host, database, user, password):
+    """VACUUM ANALYZE a database from from_host, connected to env.postgresql_database_host
+        as its owner, with psql_from_thread so that it can run beside the binarizations
+        Return the tuple (database, dead tuples before, after)
+        A plain VACUUM makes the space of the dead tuples reusable without giving
+        it back to the system, so the size of the database is not reported
+    """
+    stats = "SELECT coalesce(sum(n_dead_tup), 0) FROM pg_stat_user_tables;"
+    # no warning for the tables of postgis that the owner of the database can't vacuum
+    rows = psql_from_thread(from_host, "SET client_min_messages = error;\n{s}\nVACUUM ANALYZE;\n{s}".format(s=stats),
+                            database, env.postgresql_database_host, user, password)
+    if not rows or len(rows) != 2:
+        print(red("ERROR: can't vacuum {}".format(database)))
+        return database, 0, 0
+    dead_before, dead_after = [int(row[0]) for row in rows]
+    print(blue("{} vacuumed: {} -> {} dead tuples".format(database, dead_before, dead_after)))
+    return database, dead_before, dead_after
+
 
-    require.postgres.user(postgresql_user, instance.db_password)
-    require.postgres.database(postgresql_database, postgresql_user)
+def print_vacuum_report(results):
+    """Print the total of the results of vacuum_database"""
+    if results:
+        print(green("{} databases vacuumed, {} dead tuples removed".format(
+            len(results), sum(r[1] - r[2] for r in results))))
+
+
+@task
+@roles('db')
+def vacuum_ed_dbs():
+    """VACUUM ANALYZE the ed databases of all the instances, env.nb_thread_for_vacuum at a time"""
+    host = env.host_string
+
+    def vacuum(instance):
+        return vacuum_database(host, instance.db_name, instance.db_user, instance.db_password)
+
+    with Parallel(env.nb_thread_for_vacuum) as pool:
+        results = pool.map(vacuum, env.instances.values())
+    print_vacuum_report(results)
+
+
+@task
+@roles('db')
+def get_alembic_versions(databases):
+    """ Return the alembic revision of each given database, the ones without
+        alembic_version being left out, in two psql sessions
+    """
+    _, existing = _get_users_and_databases()
+    databases = [d for d in databases if d in existing]
+    if not databases:
+        return {}
+    rows = psql("\n".join("\\connect \"{db}\"\n"
+                          "SELECT '{db}', exists (SELECT 1 FROM pg_tables WHERE tablename = 'alembic_version');"
+                          .format(db=db) for db in databases))
+    with_alembic = [db for db, has_alembic in rows if has_alembic == 't']
+    if not with_alembic:
+        return {}
+    rows = psql("\n".join("\\connect \"{db}\"\nSELECT '{db}', version_num FROM alembic_version;".format(db=db)
+                          for db in with_alembic))
+    return dict((db, version) for db, version in rows)
+
+
+def _get_users_and_databases():
+    """Return the sets of the existing users and databases"""
+    users, databases = set(), set()
+    for kind, name in psql("SELECT 'user', rolname FROM pg_roles "
+                           "UNION ALL SELECT 'database', datname FROM pg_database;"):
+        (users if kind == 'user' else databases).add(name)
+    return users, databases
+
+
+@task
+@roles('db')
+def require_ed_template():
+    """Create the template database of the ed databases with postgis, if it does not exist
+        Its schema belongs to env.ed_template_user and is upgraded by tyr.update_ed_template
+        Nothing is done until env.ed_template_password is set
+    """
+    if not env.ed_template_database or not env.ed_template_password:
+        return
+    users, databases = _get_users_and_databases()
+    if env.ed_template_user not in users:
+        psql('CREATE USER "{}" WITH PASSWORD {};'.format(env.ed_template_user, _literal(env.ed_template_password)))
+    if env.ed_template_database not in databases:
+        # the database itself belongs to postgres, so that the copies only get the schema of the template user
+        psql('CREATE DATABASE "{db}" TEMPLATE template0 ENCODING \'UTF8\' '
+             'LC_COLLATE \'en_US.UTF-8\' LC_CTYPE \'en_US.UTF-8\';\n'
+             'GRANT ALL ON DATABASE "{db}" TO "{user}";\n'
+             'UPDATE pg_database SET datistemplate = true WHERE datname = \'{db}\';'
+             .format(db=env.ed_template_database, user=env.ed_template_user))
+    postgis_initdb(env.ed_template_database)
+
+
+@task
+@roles('db')
+def create_all_instance_dbs(instances=None):
+    """Create the missing users, databases and postgis extensions of the instances
+        (default all) with a single generated sql script, the existing ones being
+        queried at once
+        The databases are copies of the ed template database if it exists, else
+        they are created empty
+    """
+    instances = instances or env.instances.values()
+    existing_users, databases = _get_users_and_databases()
+
+    # the passwords as sql literals
+    users = dict((i.db_user, _literal(i.db_password)) for i in instances if i.db_user not in existing_users)
+    new_databases = [(i.db_name, i.db_user) for i in instances if i.db_name not in databases]
+    from_template = set()
+    if new_databases and env.ed_template_database in databases:
+        print(blue("creating {} databases from {}".format(len(new_databases), env.ed_template_database)))
+        # it fails if someone is connected to the template, the remaining databases are then created empty
+        psql(_render_template("db/create_from_ed_template.sql.jinja",
+                              {'users': sorted(users.items()), 'databases': new_databases,
+                               'template': env.ed_template_database, 'template_user': env.ed_template_user}),
+             warn_only=True)
+        existing_users, created = _get_users_and_databases()
+        from_template = created - databases
+        databases = created
+        users = dict((u, p) for u, p in users.items() if u not in existing_users)
+        new_databases = [(d, u) for d, u in new_databases if d not in databases]
+
+    # postgis of all the other existing databases of the instances in one psql session
+    with_postgis = set(from_template)
+    existing = [i.db_name for i in instances if i.db_name in databases and i.db_name not in from_template]
+    if existing:
+        rows = psql("\n".join("\\connect \"{db}\"\n"
+                              "SELECT '{db}', exists (SELECT 1 FROM pg_type WHERE typname = 'geography');"
+                              .format(db=db) for db in existing))
+        with_postgis |= set(db for db, has_postgis in rows if has_postgis == 't')
+
+    without_postgis = [i.db_name for i in instances if i.db_name not in with_postgis]
+    if not users and not new_databases and not without_postgis:
+        print(blue("all the instance databases already exist"))
+        return
+    print(blue("creating {} users, {} databases and {} postgis extensions"
+               .format(len(users), len(new_databases), len(without_postgis))))
+    # before 9.3, postgis is installed by sql scripts, see postgis_initdb
+    extension = [int(v) for v in get_psql_version()[0:2]] >= [9, 3]
+    psql(_render_template("db/create_instance_dbs.sql.jinja",
+                          {'users': sorted(users.items()), 'databases': new_databases,
+                           'postgis': without_postgis if extension else [], 'locale': 'en_US.UTF-8'}))
+    if not extension:
+        for database in without_postgis:
+            postgis_initdb(database)
+
+@task
+@roles('db')
+def create_instance_db(instance):
+    """Create the user and the database of an instance if they do not exist"""
+    create_all_instance_dbs([instance])
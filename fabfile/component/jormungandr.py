@@ -31,12 +31,15 @@
 
 import StringIO
 import ConfigParser
+import datetime
 from io import BytesIO
+import random
 import requests
 from requests.auth import HTTPBasicAuth
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, RequestException
+import simplejson as json
 from simplejson.scanner import JSONDecodeError
-from time import sleep
+from time import sleep, time
 from urllib2 import HTTPError
 
 from fabric.colors import red, green, blue, yellow
@@ -47,9 +50,10 @@ from fabric.operations import run, get
 from fabric.api import execute, task, env, sudo
 from fabtools import require
 
-from fabfile.component import kraken, load_balancer
-from fabfile.utils import (_install_packages, _upload_template,
-                           start_or_stop_with_delay, get_bool_from_cli, get_host_addr)
+from fabfile.component import db, kraken, load_balancer, pgbouncer
+from fabfile.utils import (_install_packages, _upload_template, Parallel,
+                           start_or_stop_with_delay, get_bool_from_cli, get_host_addr,
+                           get_db_pool_context)
 
 
 @task
@@ -65,8 +69,11 @@ def update_jormungandr_conf():
                      context={
                          'env': env
                      })
-    _upload_template('jormungandr/settings.py.jinja', env.jormungandr_settings_file,
-                     context={'env': env})
+    execute(db.check_db_connections, strict=False)
+    context = get_db_pool_context('jormungandr')
+    context['env'] = env
+    context['postgresql_host'], context['postgresql_port'] = pgbouncer.get_client_address()
+    _upload_template('jormungandr/settings.py.jinja', env.jormungandr_settings_file, context=context)
 
 
 @task
@@ -290,6 +297,180 @@ def test_jormungandr(server, instance=None, fail_if_error=True):
     return True
 
 
+def get_recorded_requests(server, nb_requests):
+    """ Return a random sample of the recent journeys and places requests
+        found in the jormungandr access log of a server
+    """
+    with settings(host_string=server):
+        output = run("tail -n {lines} {log} | awk '{{print $7}}' | grep -E '/(journeys|places)\?' "
+                     "| shuf -n {nb}".format(lines=nb_requests * 50, log=env.jormungandr_access_log,
+                                             nb=nb_requests))
+    return [line.strip() for line in output.split('\n') if line.strip()]
+
+
+def replay_requests(server, paths, concurrency, rate=None):
+    """ Replay requests against jormungandr on a server
+        if rate is given, the requests are sent at this rate (request/s) at most
+        return the list of (latency in s, succeeded) of all requests, a request
+        succeeding with a 2xx answer within env.jormungandr_request_timeout
+    """
+    headers = {'Host': env.jormungandr_url}
+    auth = HTTPBasicAuth(env.token, '')
+    begin = time()
+
+    def timed_request(args):
+        index, path = args
+        if rate:
+            sleep(max(0, begin + index / rate - time()))
+        start = time()
+        try:
+            response = requests.get('http://{}{}'.format(server, path), headers=headers, auth=auth,
+                                    timeout=env.jormungandr_request_timeout)
+            succeeded = 200 <= response.status_code < 300
+        except Exception:
+            succeeded = False
+        return time() - start, succeeded
+
+    with Parallel(concurrency) as pool:
+        return pool.map(timed_request, enumerate(paths))
+
+
+@task
+def warm_up_krakens(server):
+    """ Replay recent requests on a jormungandr server until its krakens latency is stable
+        To be done before putting the server back in the load balancer
+    """
+    host = get_host_addr(server)
+    paths = get_recorded_requests(server, env.warm_up_nb_requests)
+    if not paths:
+        print(yellow("WARNING: no request to replay found in {} on {}".format(env.jormungandr_access_log, host)))
+        return
+    previous_median = None
+    for nb_round in range(1, env.warm_up_max_rounds + 1):
+        latencies = sorted(l for l, _ in replay_requests(host, paths, env.warm_up_concurrency))
+        median = latencies[len(latencies) / 2]
+        print(blue("warm up of {} round {}: median latency {:.3f}s, max {:.3f}s"
+                   .format(host, nb_round, median, latencies[-1])))
+        if previous_median and abs(median - previous_median) <= env.warm_up_stability * previous_median:
+            print(green("OK: latency of {} is stable".format(host)))
+            return
+        previous_median = median
+    print(yellow("WARNING: latency of {} is still not stable after {} rounds".format(host, env.warm_up_max_rounds)))
+
+
+# upper bounds (in ms) of the buckets of the bench latency histograms
+BENCH_HISTOGRAM_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+
+
+def generate_journey_requests(server, nb_requests):
+    """ Generate journeys requests between random stop areas of all instances """
+    headers = {'Host': env.jormungandr_url}
+    auth = HTTPBasicAuth(env.token, '')
+    stop_areas = {}
+    for instance in env.instances.keys():
+        if instance in env.excluded_instances:
+            continue
+        try:
+            response = requests.get('http://{}/v1/coverage/{}/stop_areas?count=100'.format(server, instance),
+                                    headers=headers, auth=auth, timeout=env.jormungandr_request_timeout)
+            if response.status_code == 200:
+                stop_areas[instance] = [sa['id'] for sa in response.json().get('stop_areas', [])]
+            else:
+                print(yellow("WARNING: no stop areas for {} ({}), skipping it".format(instance, response.status_code)))
+        except (RequestException, JSONDecodeError) as e:
+            print(yellow("WARNING: no stop areas for {} ({}), skipping it".format(instance, e)))
+    stop_areas = dict((i, sa) for i, sa in stop_areas.iteritems() if len(sa) > 1)
+    if not stop_areas:
+        return []
+    paths = []
+    for _ in range(nb_requests):
+        instance = random.choice(stop_areas.keys())
+        origin, destination = random.sample(stop_areas[instance], 2)
+        paths.append('/v1/coverage/{}/journeys?from={}&to={}'.format(instance, origin, destination))
+    return paths
+
+
+def latency_statistics(results, duration):
+    """ Summarize the (latency, succeeded) results of a bench run of the given duration (s) """
+    latencies = sorted(l * 1000 for l, _ in results)
+    nb_errors = len([ok for _, ok in results if not ok])
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.))]
+
+    histogram = [0] * (len(BENCH_HISTOGRAM_BUCKETS) + 1)
+    bucket = 0
+    for latency in latencies:
+        while bucket < len(BENCH_HISTOGRAM_BUCKETS) and latency > BENCH_HISTOGRAM_BUCKETS[bucket]:
+            bucket += 1
+        histogram[bucket] += 1
+
+    return {
+        'nb_requests': len(results),
+        'duration_s': duration,
+        'throughput_rps': len(results) / duration if duration else 0,
+        'error_rate': float(nb_errors) / len(results),
+        'latency_ms': {
+            'mean': sum(latencies) / len(latencies),
+            'p50': percentile(50),
+            'p90': percentile(90),
+            'p99': percentile(99),
+            'max': latencies[-1],
+        },
+        # histogram[i] is the number of requests with a latency <= buckets[i]
+        # (and > buckets[i-1]), the last one counts the requests above all buckets
+        'histogram': {
+            'buckets_ms': BENCH_HISTOGRAM_BUCKETS,
+            'counts': histogram,
+        },
+    }
+
+
+@task
+def bench(server, request_file=None, nb_requests=1000, concurrency=8, rate=None, output=None):
+    """
+    Load test jormungandr on a server (ex: fab dev bench:ws1.example.com,concurrency=16,rate=50)
+
+    the requests are read from request_file (one path per line, ex: /v1/coverage/fr-idf/journeys?from=...)
+    or generated between random stop areas of each instance
+    the latency histogram, throughput and error rate are printed and written as json to output if given
+    """
+    nb_requests = int(nb_requests)
+    concurrency = int(concurrency)
+    rate = float(rate) if rate else None
+    host = get_host_addr(server)
+
+    if request_file:
+        with open(request_file) as f:
+            paths = [line.strip() for line in f if line.strip()][:nb_requests]
+    else:
+        paths = generate_journey_requests(host, nb_requests)
+    if not paths:
+        print(red("ERROR: no request to bench {}".format(host)))
+        exit(1)
+
+    print(blue("bench of {}: {} requests, concurrency {}, rate {}".format(
+        host, len(paths), concurrency, rate or 'unlimited')))
+    start = time()
+    results = replay_requests(host, paths, concurrency, rate)
+    statistics = latency_statistics(results, time() - start)
+    statistics.update({
+        'server': host,
+        'date': datetime.datetime.now().isoformat(),
+        'concurrency': concurrency,
+        'rate': rate,
+    })
+
+    print(green("{throughput_rps:.1f} req/s, {error_rate:.1%} errors".format(**statistics)))
+    print(green("latency (ms): mean {mean:.1f}, p50 {p50:.1f}, p90 {p90:.1f}, p99 {p99:.1f}, max {max:.1f}"
+                .format(**statistics['latency_ms'])))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(statistics, f, indent=2)
+        print(blue("results written in {}".format(output)))
+    return statistics
+
+
 @task()
 @roles('ws')
 def deploy_jormungandr_instance_conf(instance):
@@ -31,7 +31,9 @@
 
 import StringIO
 import ConfigParser
+import csv
 from io import BytesIO
+from pipes import quote
 from retrying import Retrying
 import simplejson as json
 from urllib2 import Request, urlopen, HTTPError
@@ -42,11 +44,12 @@ from fabric.context_managers import settings
 from fabric.contrib.files import exists, sed
 from fabric.decorators import roles, serial
 from fabric.operations import run, get
-from fabric.api import task, env, sudo
+from fabric.api import task, env, sudo, execute
 from fabtools import require, service, files
 
+from fabfile.component import pgbouncer
 from fabfile.utils import (_install_packages, get_real_instance, _upload_template,
-                           start_or_stop_with_delay, get_host_addr)
+                           start_or_stop_with_delay, get_host_addr, delta_sync_command, get_host_resources)
 
 
 @task
@@ -66,7 +69,7 @@ def setup_kraken():
 @roles('eng')
 def upgrade_engine_packages():
     packages = ['logrotate', 'python2.7', 'rabbitmq-server', 'gcc',
-            'python-dev']
+            'python-dev', 'rsync']
     if env.distrib in ('ubuntu14.04', 'debian8'):
         packages.append('libzmq3-dev')
     elif env.distrib == 'debian7':
@@ -290,6 +293,77 @@ def test_kraken(instance, fail_if_error=True, wait=False, loaded_is_ok=None):
             print(yellow("WARNING: instance {} has no loaded data".format(instance.name)))
             return False
 
+@task
+@roles('eng')
+def get_kraken_capacity():
+    """ Return the host resources and, for each instance, the size of its data,
+        the memory (in kB) and the number of threads used by its kraken
+    """
+    capacity = get_host_resources()
+    # one remote command for all the instances of the host
+    output = run('; '.join("echo \"{name}|$(stat -L -c %s {data} 2>/dev/null || echo 0)|"
+                           "$(ps -o rss=,nlwp= -p $(cat {pid} 2>/dev/null) 2>/dev/null | awk '{{print $1\"|\"$2}}')\""
+                           .format(name=instance.name, data=instance.kraken_database,
+                                   pid="{}/kraken.pid".format(instance.kraken_basedir))
+                           for instance in env.instances.values()))
+    capacity['instances'] = {}
+    for line in output.split('\n'):
+        fields = line.strip().split('|')
+        if len(fields) < 3:
+            continue
+        running = len(fields) == 4
+        capacity['instances'][fields[0]] = {
+            'data_size': int(fields[1]),
+            'rss_kb': int(fields[2]) if running else 0,
+            'nb_threads': int(fields[3]) if running else 0,
+            'last_load_at': None,
+        }
+
+    for name, values in capacity['instances'].iteritems():
+        request = Request('http://{}:{}/{}/?instance={}'.format(env.host,
+            env.kraken_monitor_port, env.kraken_monitor_location_dir, name))
+        try:
+            values['last_load_at'] = json.loads(urlopen(request).read()).get('last_load_at')
+        except Exception:
+            pass
+    return capacity
+
+
+@task
+def capacity_report(output='capacity_report'):
+    """
+    Write a capacity report of all the engines in <output>.csv and <output>.json
+
+    for each instance on each engine: data size, kraken memory and threads, last load,
+    and for each engine: memory used by the krakens, headroom now and after a year
+    of growth (env.capacity_growth_rate)
+    """
+    capacities = execute(get_kraken_capacity)
+    rows = []
+    for host, capacity in sorted(capacities.iteritems()):
+        used_kb = sum(i['rss_kb'] for i in capacity['instances'].values())
+        capacity['krakens_rss_kb'] = used_kb
+        capacity['headroom_kb'] = capacity['mem_total_kb'] - used_kb
+        capacity['projected_headroom_kb'] = capacity['mem_total_kb'] - int(used_kb * (1 + env.capacity_growth_rate))
+        color = green if capacity['projected_headroom_kb'] > 0 else red
+        print(color("{}: {} cores, krakens use {} of {} MB, headroom {} MB now, {} MB in a year".format(
+            host, capacity['cores'], used_kb / 1024, capacity['mem_total_kb'] / 1024,
+            capacity['headroom_kb'] / 1024, capacity['projected_headroom_kb'] / 1024)))
+        for name, values in sorted(capacity['instances'].iteritems()):
+            rows.append([host, name, values['data_size'], values['rss_kb'], values['nb_threads'],
+                         values['last_load_at'], capacity['cores'], capacity['mem_total_kb'],
+                         capacity['headroom_kb'], capacity['projected_headroom_kb']])
+
+    with open(output + '.csv', 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['host', 'instance', 'data_size', 'rss_kb', 'nb_threads', 'last_load_at',
+                         'host_cores', 'host_mem_total_kb', 'host_headroom_kb', 'host_projected_headroom_kb'])
+        writer.writerows(rows)
+    with open(output + '.json', 'w') as f:
+        json.dump(capacities, f, indent=2)
+    print(blue("capacity report written in {0}.csv and {0}.json".format(output)))
+
+
 @task
 @roles('eng')
 def disable_rabbitmq_kraken():
@@ -332,6 +406,7 @@ def update_eng_instance_conf(instance):
                      context={
                          'env': env,
                          'instance': instance,
+                         'chaos_database': pgbouncer.get_chaos_database(instance),
                      }
     )
 
@@ -392,6 +467,87 @@ def create_eng_instance(instance):
                format(instance=instance.name, server=get_host_addr(env.host_string))))
 
 
+def get_distribution_pending_file(instance):
+    """ Return the file marking a data.nav.lz4 of an instance not pushed to the
+        engines yet
+    """
+    return instance.target_lz4_file + '.undistributed'
+
+
+def get_distribution_script(instance):
+    """ Return the shell commands pushing the data.nav.lz4 of an instance from
+        the current host to the local dir of all engines (see distribute_datanav)
+        They need bash with pipefail, exit with an error status if a copy fails
+        and remove get_distribution_pending_file once all the copies are done
+    """
+    engines = env.roledefs['eng']
+    source = instance.target_lz4_file
+    ssh = 'ssh -o BatchMode=yes'
+    if env.datanav_distribution == 'rsync':
+        lines = ['{} || exit 1'.format(delta_sync_command(source, '{}:{}'.format(engine, instance.kraken_database)))
+                 for engine in engines]
+    else:
+        part_file = instance.kraken_database + '.part'
+        # build the command from the tail of the chain: the last engine only writes
+        # the stream, the others write it and forward it to their successor
+        hop_cmd = "cat > {}".format(part_file)
+        for engine in reversed(engines[1:]):
+            hop_cmd = "tee {part} | {ssh} {engine} {cmd}".format(part=part_file, ssh=ssh,
+                                                                engine=engine, cmd=quote(hop_cmd))
+        # the source is read once: tee sends it to the first engine through fd 3 and
+        # to md5sum, whose result comes back on the original stdout (fd 4)
+        lines = ["md5=$({{ {{ tee /dev/fd/3 < {src} | md5sum | cut -d' ' -f1 >&4; }} 3>&1 "
+                 "| {ssh} {engine} {cmd}; }} 4>&1) || exit 1"
+                 .format(src=source, ssh=ssh, engine=engines[0], cmd=quote(hop_cmd))]
+        # each engine checks its copy against the md5 given on stdin before moving it in place
+        check = ('read md5; test "$(md5sum {part} | cut -d" " -f1)" = "$md5" && mv -f {part} {db} '
+                 '|| {{ rm -f {part}; exit 1; }}'.format(part=part_file, db=instance.kraken_database))
+        lines += ['echo "$md5" | {ssh} {engine} {check} '
+                  '|| {{ echo "ERROR: {part} on {engine} is corrupted" >&2; exit 1; }}'
+                  .format(ssh=ssh, engine=engine, check=quote(check), part=part_file)
+                  for engine in engines]
+    lines.append('rm -f {}'.format(get_distribution_pending_file(instance)))
+    return '\n'.join(lines)
+
+
+@task
+@roles('tyr_master')
+def distribute_datanav(instance):
+    """ Push the data.nav.lz4 of an instance to the local dir of all engines
+        following env.datanav_distribution:
+        * 'chain': the file is read once on tyr and streamed along the chain
+          tyr -> eng1 -> eng2 -> ..., each engine writing it while forwarding it
+          to the next one, so the source is never read N times in parallel.
+          Each copy is then checked against the md5 of the source, computed in
+          the same stream, before being moved in place.
+        * 'rsync': only the blocks that changed since the previous data are sent
+          to each engine
+        The data binarized by tyr itself are pushed the same way by the
+        env.datanav_publisher cron of tyr_master (see tyr.update_datanav_publisher),
+        both as env.KRAKEN_USER
+    """
+    instance = get_real_instance(instance)
+    engines = env.roledefs['eng']
+    if not engines:
+        return
+    print(blue("NOTICE: sending {} to {}".format(instance.target_lz4_file, ' -> '.join(engines))))
+    # no pty, so that nothing but the commands output can get in the md5
+    sudo("set -o pipefail\n" + get_distribution_script(instance), user=env.KRAKEN_USER, pty=False)
+
+
+@task
+@roles('tyr_master')
+def distribute_all_datanav():
+    """ Push the data.nav.lz4 of all instances to the engines (see distribute_datanav) """
+    for instance in env.instances.values():
+        if instance.name in env.excluded_instances:
+            print(blue("NOTICE: instance {} has been excluded, skipping it".format(instance.name)))
+        elif not exists(instance.target_lz4_file):
+            print(yellow("WARNING: no {}, skipping it".format(instance.target_lz4_file)))
+        else:
+            distribute_datanav(instance)
+
+
 @task
 @roles('eng')
 def remove_kraken_instance(instance, purge_logs=False):
@@ -31,38 +31,79 @@
 
 import StringIO
 import ConfigParser
+import datetime
+import hashlib
+import multiprocessing
 import os
+from Queue import Empty
+import threading
 from io import BytesIO
 from retrying import Retrying, RetryError
+import simplejson as json
 import time
 
 from fabric.api import execute, env, task
 from fabric.colors import red, blue, green, yellow
 from fabric.context_managers import settings, warn_only, cd, shell_env
 from fabric.contrib.files import exists
-from fabric.decorators import roles
+from fabric.decorators import roles, parallel
 from fabric.operations import run, get, sudo, put
 from fabtools import require, python, files, service
 
-from fabfile.component import db
+from fabfile.component import db, kraken, pgbouncer
 from fabfile.component.kraken import get_no_data_instances
 from fabfile import utils
 from fabfile.utils import _install_packages, _upload_template, start_or_stop_with_delay
 
 
+def get_tyr_worker_context():
+    """ Return the template context of the tyr worker, with its concurrency and
+        max memory by process fitted to the cores and memory of the current host
+        unless forced by env.tyr_worker_concurrency and env.tyr_worker_max_memory_per_child
+        The max memory needs celery >= 4, before that the worker processes are
+        replaced after env.tyr_worker_max_tasks_per_child tasks
+    """
+    context = utils.get_tyr_worker_resources()
+    context['celery_version'] = get_celery_version()
+    if context['celery_version'] < [4]:
+        print(blue("tyr worker on {}: concurrency {}, {} binarizations by process".format(
+            env.host_string, context['tyr_worker_concurrency'], env.tyr_worker_max_tasks_per_child)))
+    elif not env.tyr_worker_concurrency or not env.tyr_worker_max_memory_per_child:
+        print(blue("tyr worker on {}: concurrency {}, max memory by process {} MB".format(
+            env.host_string, context['tyr_worker_concurrency'], context['tyr_worker_max_memory_per_child'] / 1024)))
+    context['env'] = env
+    return context
+
+
+def get_celery_version():
+    """ Return the version of the celery of the current host as a list of ints,
+        [] if it is not installed yet
+    """
+    output = run("/usr/local/bin/celery --version", quiet=True)
+    if output.failed:
+        return []
+    return [int(v) for v in output.split()[0].split('.') if v.isdigit()]
+
+
 @task
 @roles('tyr')
 def update_tyr_conf():
+    execute(db.check_db_connections, strict=False)
+    pool_context = utils.get_db_pool_context('tyr')
+    postgresql_host, postgresql_port = pgbouncer.get_client_address()
     _upload_template("tyr/settings.py.jinja", env.tyr_settings_file,
                      context={
                         'env': env,
+                        'db_pool_size': pool_context['db_pool_size'],
+                        'db_max_overflow': pool_context['db_max_overflow'],
                         'tyr_broker_username': env.tyr_broker_username,
                         'tyr_broker_password': env.tyr_broker_password,
                         'rabbitmq_host': env.rabbitmq_host,
                         'rabbitmq_port': env.rabbitmq_port,
                         'tyr_postgresql_user': env.tyr_postgresql_user,
                         'tyr_postgresql_password': env.tyr_postgresql_password,
-                        'postgresql_database_host': env.postgresql_database_host,
+                        'postgresql_database_host': postgresql_host,
+                        'postgresql_port': postgresql_port,
                         'tyr_postgresql_database': env.tyr_postgresql_database,
                         'tyr_base_instances_dir': env.tyr_base_instances_dir,
                         'tyr_base_logfile': env.tyr_base_logfile,
@@ -126,9 +167,7 @@ def setup_tyr():
                          'env': env
                      })
     _upload_template('tyr/tyr_worker.jinja', env.tyr_worker_service_file, user='root', mode='755',
-                     context={
-                         'env': env
-                     })
+                     context=get_tyr_worker_context())
 
     if not files.is_dir(env.tyr_migration_dir):
         files.symlink('/usr/share/tyr/migrations/', env.tyr_migration_dir, use_sudo=True)
@@ -152,6 +191,7 @@ def upgrade_tyr_packages():
         'logrotate',
         'python2.7',
         'git',
+        'rsync',
         'postgresql-server-dev-all'
         ]
     if env.distrib == 'ubuntu14.04':
@@ -170,7 +210,7 @@ def upgrade_tyr_packages():
     _upload_template('tyr/tyr_beat.jinja', env.tyr_beat_service_file,
                      context={'env': env}, mode='755')
     _upload_template('tyr/tyr_worker.jinja', env.tyr_worker_service_file,
-                     context={'env': env}, mode='755')
+                     context=get_tyr_worker_context(), mode='755')
 
 @task
 @roles('tyr_master')
@@ -210,13 +250,77 @@ def update_ed_db(instance):
             print("cd {env}/{instance}; PYTHONPATH=. alembic upgrade head"
                   .format(env=env.ed_basedir, instance=instance))
         else:
-            with cd("{env}/{instance}".format(env=env.ed_basedir, instance=instance)):
-                run("PYTHONPATH=. alembic upgrade head")
+            # no cd() context, update_ed_db can be called from several threads
+            run("cd {env}/{instance} && PYTHONPATH=. alembic upgrade head"
+                .format(env=env.ed_basedir, instance=instance))
     else:
         print(red("ERROR: {env}/{instance} does not exists. skipping db update"
                   .format(env=env.ed_basedir, instance=instance)))
 
 
+def get_ed_alembic_head():
+    """ Return the head revision of the ed schema, or None if no ed instance is deployed """
+    ed_dirs = [d for d in ("{}/{}".format(env.ed_basedir, i) for i in env.instances.keys()) if exists(d)]
+    if not ed_dirs:
+        return None
+    # all the ed instances share the same migration scripts
+    output = run("cd {} && PYTHONPATH=. alembic heads".format(ed_dirs[0]), warn_only=True)
+    lines = [l for l in output.split('\n') if l.strip()]
+    return lines[-1].split()[0] if output.succeeded and lines else None
+
+
+@task
+@roles('tyr_master')
+def update_all_ed_db():
+    """ Upgrade the schema of the ed databases which are not at head
+        The current revision of all databases is read in one batch, the
+        outdated ones are upgraded env.nb_thread_for_ed_migration at a time
+    """
+    head = get_ed_alembic_head()
+    instances = env.instances.values()
+    versions = execute(db.get_alembic_versions, [i.db_name for i in instances]).values()[0]
+    outdated = [i.name for i in instances if head is None or versions.get(i.db_name) != head]
+    print(blue("{} ed databases at head {}, {} to upgrade".format(
+        len(instances) - len(outdated), head, len(outdated))))
+
+    def upgrade(i_name):
+        with utils.time_that(blue("ed database of " + i_name + " upgraded in {elapsed}")):
+            update_ed_db(i_name)
+
+    with utils.Parallel(env.nb_thread_for_ed_migration) as pool:
+        pool.map(upgrade, outdated)
+    # the new databases are created from the template at head
+    update_ed_template()
+
+
+@task
+@roles('tyr_master')
+def update_ed_template():
+    """ Upgrade the schema of the ed template database, see db.require_ed_template """
+    if not env.ed_template_database:
+        return
+    if not env.ed_template_password:
+        print(yellow("WARNING: env.ed_template_password is not set, the ed databases are created without "
+                     "the {} template".format(env.ed_template_database)))
+        return
+    execute(db.require_ed_template)
+    template_dir = "{}/{}".format(env.ed_basedir, env.ed_template_database)
+    utils.require_directory(template_dir, owner='www-data', group='www-data', use_sudo=True)
+    _upload_template("tyr/ed_alembic.ini.jinja", "{}/alembic.ini".format(template_dir),
+                     context={
+                         'env': env,
+                         'instance': {
+                             'db_user': env.ed_template_user,
+                             'db_password': env.ed_template_password,
+                             'db_name': env.ed_template_database,
+                         },
+                     },
+    )
+    if run("cd {} && PYTHONPATH=. alembic upgrade head".format(template_dir), warn_only=True).failed:
+        # the databases of the new instances will be upgraded by update_ed_db anyway
+        print(yellow("WARNING: can't upgrade the ed template database {}".format(env.ed_template_database)))
+
+
 # TODO: testme
 # @task
 # def verify_tyr_dest_dir_exists(server):
@@ -249,9 +353,70 @@ def start_tyr_beat():
 def tyr_beat_status():
     sudo("service tyr_beat status")
 
+def _celery_control(command):
+    """ Run a celery control/inspect command against the tyr worker of the current host """
+    return run("cd {dir} && TYR_CONFIG_FILE={settings} /usr/local/bin/celery -A tyr.tasks {cmd} "
+               "--destination celery@$(hostname) --timeout 10"
+               .format(dir=env.tyr_basedir, settings=env.tyr_settings_file, cmd=command), warn_only=True)
+
+
+def _get_worker_jobs():
+    """ Return the jobs running on the tyr worker of the current host or reserved
+        by it (prefetched, they will run there too), None if it does not answer
+    """
+    jobs = []
+    for method in ('active', 'reserved'):
+        output = _celery_control("inspect {} --json".format(method))
+        try:
+            jobs += [job for host_jobs in json.loads(output.split('\n')[-1]).values() for job in host_jobs]
+        except ValueError:
+            return None
+    return jobs
+
+
+def drain_tyr_worker(timeout):
+    """ Stop the tyr worker of the current host from taking new jobs and wait up to
+        timeout seconds for its running and reserved jobs to finish
+        Return the jobs not finished at the deadline
+    """
+    print(blue("draining tyr_worker on {}".format(env.host_string)))
+    _celery_control("control cancel_consumer {}".format(env.tyr_worker_queue))
+    start = time.time()
+    while True:
+        jobs = _get_worker_jobs()
+        if jobs is None:
+            print(yellow("WARNING: tyr_worker on {} does not answer, can't drain it".format(env.host_string)))
+            return []
+        if not jobs:
+            print(green("tyr_worker on {} drained in {}s".format(env.host_string, int(time.time() - start))))
+            return []
+        elapsed = time.time() - start
+        if elapsed >= timeout:
+            return jobs
+        print(blue("{} jobs still running or reserved on {} after {}s (deadline {}s): {}".format(
+            len(jobs), env.host_string, int(elapsed), timeout, ', '.join(j.get('name', '?') for j in jobs))))
+        time.sleep(min(env.tyr_worker_drain_poll, timeout - elapsed))
+
+
 @task
 @roles('tyr')
-def stop_tyr_worker():
+@parallel
+def stop_tyr_worker(drain=None):
+    """ Stop the tyr workers, all at the same time
+        with drain (default env.drain_tyr_worker), the running and reserved jobs are
+        given up to env.tyr_worker_drain_timeout seconds to finish before the worker
+        is stopped
+    """
+    if drain is None:
+        drain = env.drain_tyr_worker
+    if utils.get_bool_from_cli(drain) and require.service.is_running('tyr_worker'):
+        cancelled_jobs = drain_tyr_worker(env.tyr_worker_drain_timeout)
+        if cancelled_jobs:
+            print(red("deadline reached on {}, these jobs will be cancelled and must be re-queued:"
+                      .format(env.host_string)))
+            for job in cancelled_jobs:
+                print(red("  {} {} args={} kwargs={}".format(job.get('id'), job.get('name'),
+                                                            job.get('args'), job.get('kwargs'))))
     if not start_or_stop_with_delay('tyr_worker', delay=8000, wait=500, start=False, exc_raise=False):
         print(red("there are still tyr_worker alive, something is wrong"))
         if env.kill_ghost_tyr_worker:
@@ -299,56 +464,202 @@ def start_services():
     require.service.started('rabbitmq-server')
     require.service.started('redis-server')
 
+def _copy_datanav(source, destination, inplace=False):
+    """ Copy a data.nav.lz4, reading it at most once:
+        * as a reflink if the filesystem allows it (btrfs, xfs...), no data is copied
+        * with a rsync delta transfer if env.use_delta_sync (in place if inplace)
+        * else the md5 of the data is computed while it is copied
+        The md5 of the copy is stored in <destination>.md5 in all cases
+        The destination is replaced atomically (except for an in place delta transfer)
+        Return True if the copy succeeded
+    """
+    part_file = destination + '.part'
+    if run("cp --reflink=always {} {}".format(source, part_file), quiet=True).succeeded:
+        run("mv -f {} {}".format(part_file, destination))
+        run("md5sum {0} | cut -d' ' -f1 > {0}.md5".format(destination))
+        return True
+    # cp leaves an empty file when the filesystem has no reflinks
+    run("rm -f {}".format(part_file))
+    if env.use_delta_sync:
+        utils.delta_sync(source, destination, inplace=inplace)
+        run("md5sum {0} | cut -d' ' -f1 > {0}.md5".format(destination))
+        return True
+
+    # nfsv4 acl, don't try to preserve permissions, inheritance do the work
+    if env.standalone:
+        run("cp --attributes-only --archive --dereference {} {}".format(source, part_file))
+    md5 = run("set -o pipefail; tee {} < {} | md5sum | cut -d' ' -f1".format(part_file, source), warn_only=True)
+    if md5.failed:
+        run("rm -f {}".format(part_file))
+        print(red("ERROR: copy of {} to {} failed (No space left on device ?)".format(source, destination)))
+        return False
+    run("mv -f {} {}".format(part_file, destination))
+    run("echo {} > {}.md5".format(md5, destination))
+    return True
+
+
+def _get_datanav_generations(instance):
+    """ Return the sorted list of the data.nav.lz4 generations of an instance and the current one """
+    output = run("ls -1 {}".format(instance.datanav_generations_dir), quiet=True)
+    generations = sorted(output.split()) if output.succeeded else []
+    link = run("readlink {}".format(instance.target_lz4_file), quiet=True)
+    current = link.split('/')[-2] if link.succeeded and '/' in link else None
+    return generations, current
+
+
+def _switch_datanav_generation(instance, generation):
+    """ Atomically point the data.nav.lz4 of an instance to one of its generations """
+    link = instance.target_lz4_file + '.link'
+    run("ln -sfn {dir}/{gen}/{data} {link} && mv -T {link} {target}".format(
+        dir=instance.datanav_generations_dir, gen=generation, data=env.kraken_data_nav,
+        link=link, target=instance.target_lz4_file))
+    print(green("OK: {} now uses the data generation {}".format(instance.name, generation)))
+
+
 @task
 @roles('tyr')
+def update_datanav_publisher():
+    """ Install the script publishing the data.nav.lz4 binarized by tyr as new
+        generations (see snapshot_datanav) on the tyr hosts, and on tyr_master
+        its cron running it every minute for the binarizations scheduled by tyr
+        Unless env.datanav_distribution is 'shared', the script also pushes the
+        new generations to the engines (see kraken.distribute_datanav)
+    """
+    cron = '/etc/cron.d/navitia_publish_datanav'
+    if not env.datanav_generations:
+        sudo("rm -f {}".format(cron))
+        if env.datanav_distribution != 'shared':
+            # nothing would push the binarizations scheduled by tyr
+            print(red("ERROR: env.datanav_distribution = '{}' needs env.datanav_generations"
+                      .format(env.datanav_distribution)))
+            exit(1)
+        return
+    instances = sorted(env.instances.values(), key=lambda i: i.name)
+    context = {'env': env, 'instances': instances, 'distributions': {}, 'undistributed': {}}
+    if env.datanav_distribution != 'shared':
+        for instance in instances:
+            context['distributions'][instance.name] = kraken.get_distribution_script(instance)
+            context['undistributed'][instance.name] = kraken.get_distribution_pending_file(instance)
+    _upload_template("tyr/publish_datanav.jinja", env.datanav_publisher, user=env.KRAKEN_USER, mode='755',
+                     context=context)
+    if env.host_string in env.roledefs['tyr_master']:
+        _upload_template("tyr/publish_datanav.cron.jinja", cron, user='root', mode='644',
+                         context={'env': env})
+    else:
+        sudo("rm -f {}".format(cron))
+
+
+@task
+@roles('tyr_master')
+def snapshot_datanav(instance):
+    """ Turn the data.nav.lz4 freshly binarized by tyr in its staging file
+        (or a plain data.nav.lz4 from before the generations) into a new generation
+        The file is moved and checksummed in a new generation directory, the
+        data.nav.lz4 becomes a symlink to it and the generations beyond the
+        env.datanav_generations last ones are removed, by env.datanav_publisher
+        (see update_datanav_publisher)
+        The new data are not pushed to the engines, see kraken.distribute_datanav
+    """
+    instance = utils.get_real_instance(instance)
+    if not exists(env.datanav_publisher):
+        print(red("ERROR: {} is missing, run tasks.tyr.update_datanav_publisher".format(env.datanav_publisher)))
+        exit(1)
+    sudo("{} --no-distribution {}".format(env.datanav_publisher, instance.name), user=env.KRAKEN_USER)
+
+
+@task
+@roles('tyr_master')
+def list_datanav_generations(instance):
+    """ Print the data.nav.lz4 generations of an instance """
+    instance = utils.get_real_instance(instance)
+    generations, current = _get_datanav_generations(instance)
+    for generation in generations:
+        if generation == current:
+            print(green("{} (current)".format(generation)))
+        else:
+            print(generation)
+
+
+@task
+@roles('tyr_master')
+def switch_datanav_generation(instance, generation, check=False):
+    """ Use a given data.nav.lz4 generation of an instance and restart its krakens
+        with check, the md5 of the generation is verified before the switch
+        Unless env.datanav_distribution is 'shared', the generation is pushed to
+        the engines before the restart
+    """
+    instance = utils.get_real_instance(instance)
+    generations, current = _get_datanav_generations(instance)
+    if generation not in generations:
+        print(red("ERROR: no data generation {} for {}".format(generation, instance.name)))
+        exit(1)
+    if generation == current:
+        print(blue("NOTICE: {} already uses the data generation {}".format(instance.name, generation)))
+        return
+    if utils.get_bool_from_cli(check):
+        data_file = "{}/{}/{}".format(instance.datanav_generations_dir, generation, env.kraken_data_nav)
+        if run('test "$(md5sum {0} | cut -d" " -f1)" = "$(cat {0}.md5)"'.format(data_file), quiet=True).failed:
+            print(red("ERROR: {} is corrupted".format(data_file)))
+            exit(1)
+    _switch_datanav_generation(instance, generation)
+    if env.datanav_distribution != 'shared':
+        kraken.distribute_datanav(instance)
+    execute(kraken.restart_kraken, instance)
+
+
+@task
+@roles('tyr_master')
 def backup_datanav(instance):
     """ Backup a data.nav.lz4 for a given instance in data.nav.lz4_$instance"""
 
-    env.tyr_config = get_tyr_config(instance)
-    kraken_db = env.tyr_config.get('instance', 'target-file')
+    if env.datanav_generations:
+        snapshot_datanav(instance)
+        return
+
+    kraken_db = get_tyr_config(instance).get('instance', 'target-file')
 
     # if data.nav.lz4 found, copy it
     if exists("%s" % (kraken_db)):
-        # nfsv4 acl, don't try to preserve permissions, inheritance do the work
-        if env.standalone is False:
-            run("cp %s %s_%s" % (kraken_db, kraken_db, instance))
-        else:
-            run("cp --archive %s %s_%s" % (kraken_db, kraken_db, instance))
-
-        # verify backup
-        print("Verify backup")
-        md5_db = run("md5sum %s | awk '{print $1}'" % kraken_db)
-        md5_dbcpy = run("md5sum %s_%s | awk '{print $1}'" % (kraken_db, instance))
-
-        if md5_db != md5_dbcpy:
-            print(red("%s and %s are not equals, exiting. (No space left on device ?)" % (kraken_db, kraken_db + '_' + instance)))
+        # the backup is not read by anyone, it can be updated in place
+        if _copy_datanav(kraken_db, "%s_%s" % (kraken_db, instance), inplace=True):
+            print(green("OK: %s backed up" % instance))
     else:
         print(yellow("WARNING: %s doesn't have a data.nav.lz4, add it to the auto-exclusion list for binarization" % instance))
         env.excluded_instances.append(instance)
 
 @task
-@roles('tyr')
-def rollback_datanav(instance):
-    """ Rollback a data.nav.lz4_$instance file for a given instance """
+@roles('tyr_master')
+def backup_all_datanav():
+    """ Backup the data.nav.lz4 of all instances, env.nb_thread_for_backup at a time """
+    with utils.time_that(blue("all data.nav.lz4 backed up in {elapsed}")):
+        with utils.Parallel(env.nb_thread_for_backup) as pool:
+            pool.map(backup_datanav, env.instances.keys())
+
+@task
+@roles('tyr_master')
+def rollback_datanav(instance, generation=None):
+    """ Rollback a data.nav.lz4_$instance file for a given instance
+        or switch back to a data generation (see snapshot_datanav), by default
+        the one before the current one; give it explicitly to be able to run
+        the rollback again safely
+    """
+
+    if env.datanav_generations:
+        if generation is None:
+            generations, current = _get_datanav_generations(utils.get_real_instance(instance))
+            if current not in generations or generations.index(current) == 0:
+                print(red("ERROR: no data generation to rollback to for %s" % instance))
+                return
+            generation = generations[generations.index(current) - 1]
+        switch_datanav_generation(instance, generation)
+        return
 
-    env.tyr_config = get_tyr_config(instance)
-    kraken_db = env.tyr_config.get('instance', 'target-file')
+    kraken_db = get_tyr_config(instance).get('instance', 'target-file')
 
     # if data.nav.lz4 backup found, copy it
     if exists("%s_%s" % (kraken_db, instance)):
-        # nfsv4 acl, don't try to preserve permissions, inheritance do the work
-        if env.standalone is False:
-            run("cp %s_%s %s" % (kraken_db, instance, kraken_db))
-        else:
-            run("cp --archive %s_%s %s" % (kraken_db, instance, kraken_db))
-
-        # verify backup
-        print("Verify backup")
-        md5_db = run("md5sum %s | awk '{print $1}'" % kraken_db)
-        md5_dbcpy = run("md5sum %s_%s | awk '{print $1}'" % (kraken_db, instance))
-
-        if md5_db != md5_dbcpy:
-            print(red("%s and %s are not equals, exiting. (No space left on device ?)" % (kraken_db, kraken_db + '_' + instance)))
+        if _copy_datanav("%s_%s" % (kraken_db, instance), kraken_db):
+            print(green("OK: %s rolled back" % instance))
     else:
         print(red("ERROR: %s_%s does not exist" % (kraken_db, instance)))
 
@@ -375,10 +686,46 @@ def get_tyr_config(instance):
     else:
         return None
 
+def get_binarization_fingerprints(instances):
+    """ Return for each instance the fingerprint of the inputs of its binarization:
+        its last data_sets (name, size and modification date), the ed schema head
+        and the navitia-ed version, computed on the current host (tyr_master)
+    """
+    data_sets = execute(db.get_last_done_data_sets).values()[0]
+    files = [f for i in instances for f in data_sets.get(i, [])]
+    stats = {}
+    if files:
+        for line in run("stat -c '%n|%s|%Y' {} 2>/dev/null".format(' '.join(files)), warn_only=True).split('\n'):
+            name, _, stat = line.strip().partition('|')
+            stats[name] = stat
+    ed_version = run("dpkg-query -W -f='${Version}' navitia-ed", warn_only=True)
+    ed_head = get_ed_alembic_head()
+
+    fingerprints = {}
+    for instance in instances:
+        inputs = [ed_version, ed_head] + sorted('{}|{}'.format(f, stats.get(f)) for f in data_sets.get(instance, []))
+        fingerprints[instance] = hashlib.md5(json.dumps(inputs)).hexdigest()
+    return fingerprints
+
+
+def get_last_binarization_fingerprints(instances):
+    """ Return for each instance the fingerprint of its last successful binarization """
+    output = run("; ".join('echo "{i}|$(cat {d}/{i}/binarization.fingerprint 2>/dev/null)"'
+                           .format(i=i, d=env.ed_basedir) for i in instances))
+    return dict(line.strip().split('|', 1) for line in output.split('\n') if '|' in line)
+
+
 @task
 @roles('tyr_master')
-def launch_rebinarization_upgrade():
-    """launch binarization on all instances for the upgrade"""
+def launch_rebinarization_upgrade(force=False, distributed=None, resume=False):
+    """launch binarization on all instances for the upgrade
+        unless force, the instances whose binarization inputs did not change since
+        their last binarization are skipped (see env.skip_unchanged_binarization)
+        if distributed (default env.distributed_bina), the instances are binarized
+        by all the tyr hosts
+        if resume, the instances already done by an interrupted run for the same
+        platform and navitia-ed version are not binarized again (see env.bina_checkpoint_file)
+    """
 
     # avoid any other normal binarization during upgrade
     stop_tyr_beat()
@@ -400,30 +747,327 @@ def launch_rebinarization_upgrade():
     #for instance in already_binarized_instances:
     #   env.excluded_instances.append(instance)
 
-    def binarize_instance(i_name):
-        with utils.time_that(blue("data loaded for " + i_name + " in {elapsed}")):
-            print(blue("loading data for {}".format(i_name)))
-            update_ed_db(i_name)
+    if distributed is None:
+        distributed = env.distributed_bina
+    # upgrade the ed databases first, all at once
+    update_all_ed_db()
+    skip_unchanged = env.skip_unchanged_binarization and not utils.get_bool_from_cli(force)
+    fingerprints = get_binarization_fingerprints(env.instances.keys())
+    last_fingerprints = get_last_binarization_fingerprints(env.instances.keys()) if skip_unchanged else {}
+    run_key = get_bina_run_key()
+    if utils.get_bool_from_cli(resume):
+        checkpoint = get_bina_checkpoint(run_key)
+        if checkpoint:
+            print(blue("NOTICE: resuming binarization for navitia-ed {}, already done: {}"
+                       .format(run_key[-1], ', '.join(sorted(checkpoint)))))
+    else:
+        checkpoint = {}
+        reset_bina_checkpoint(run_key)
+    todo = [(i_name, fingerprints[i_name] != last_fingerprints.get(i_name), run_key)
+            for i_name in env.instances.keys() if i_name not in checkpoint]
+
+    distributed = utils.get_bool_from_cli(distributed) and len(env.roledefs['tyr']) > 1
+    nb_slots = sum(env.tyr_bina_slots.get(h, env.nb_thread_for_bina) for h in env.roledefs['tyr']) \
+        if distributed else env.nb_thread_for_bina
+    to_binarize = [i_name for i_name, changed, _ in todo if changed and i_name not in env.excluded_instances]
+
+    # the vacuums of the rebuilt ed databases run beside the binarizations, but
+    # only env.nb_thread_for_vacuum at a time, from this host without changing env
+    vacuums = []
+    tyr_master = env.host_string
+    with utils.Parallel(env.nb_thread_for_vacuum) as vacuum_pool, \
+            BinarizationProgress([i_name for i_name, _, _ in todo], to_binarize, nb_slots) as progress:
+        if distributed:
+            # each tyr host takes the next instance of the common queue as soon as one of its slots is free
+            queue = multiprocessing.Queue()
+            for job in todo:
+                queue.put(job)
+            results = execute(_binarization_worker, queue, progress.events, hosts=env.roledefs['tyr'])
+            statuses = [s for host_statuses in results.values() for s in host_statuses]
+            if env.vacuum_after_bina:
+                vacuums = [vacuum_pool.apply_async(vacuum_ed_db, i_name, tyr_master)
+                           for i_name, status in statuses if status == 'rebuilt']
+        else:
+            def binarize(job):
+                progress.start(job[0])
+                i_name, status = _binarize_instance(*job)
+                progress.finish(i_name, status)
+                if status == 'rebuilt' and env.vacuum_after_bina:
+                    vacuums.append(vacuum_pool.apply_async(vacuum_ed_db, i_name, tyr_master))
+                return i_name, status
+
+            if env.adaptive_bina:
+                # the number of parallele bina follows the load of the db and tyr hosts
+                pool = utils.AdaptiveParallel(env.bina_min_concurrency, env.bina_max_concurrency,
+                                              _get_bina_overload, start=env.nb_thread_for_bina,
+                                              interval=env.bina_adapt_interval)
+            else:
+                # we run the bina in parallele (if you want sequenciel run, set env.nb_thread_for_bina = 1)
+                pool = utils.Parallel(env.nb_thread_for_bina)
+            with pool:
+                statuses = pool.map(binarize, todo)
+
+    start_tyr_beat()
+    db.print_vacuum_report([v.get() for v in vacuums])
+
+    # the instances of a host which went down are lost
+    done = set(i_name for i_name, _ in statuses)
+    statuses += [(i_name, 'failed') for i_name, _, _ in todo if i_name not in done]
+    # the instances done by the interrupted run are reported, and their fingerprint written, as well
+    statuses += checkpoint.items()
+    report = dict((status, []) for status in ('rebuilt', 'skipped', 'excluded', 'failed'))
+    for i_name, status in statuses:
+        report[status].append(i_name)
+    if report['rebuilt']:
+        run("; ".join("echo {} > {}/{}/binarization.fingerprint".format(fingerprints[i], env.ed_basedir, i)
+                      for i in report['rebuilt']))
+    for status, color in (('rebuilt', green), ('skipped', blue), ('excluded', yellow), ('failed', red)):
+        if report[status]:
+            print(color("{} {}: {}".format(len(report[status]), status, ', '.join(sorted(report[status])))))
+
+
+def vacuum_ed_db(i_name, from_host):
+    """ VACUUM ANALYZE the ed database of an instance from from_host, as its
+        owner, see db.vacuum_database
+    """
+    instance = env.instances[i_name]
+    return db.vacuum_database(from_host, instance.db_name, instance.db_user, instance.db_password)
+
+
+def _get_bina_overload():
+    """ Return why the db or tyr_master host is too loaded to run more
+        binarizations, None if it is not
+    """
+    for host in set(env.roledefs['db'] + env.roledefs['tyr_master']):
+        load = utils.get_host_load(host)
+        if load['load'] > env.bina_max_load:
+            return "load of {:.1f} per core on {}".format(load['load'], host)
+        if load['iowait'] > env.bina_max_iowait:
+            return "iowait of {:.0%} on {}".format(load['iowait'], host)
+        if load['mem_available'] < env.bina_min_mem_available:
+            return "only {:.0%} of memory available on {}".format(load['mem_available'], host)
+    return None
+
 
-            if i_name in env.excluded_instances:
-                print(blue("NOTICE: i_name {} has been excluded, skiping it".format(i_name)))
+class BinarizationProgress(object):
+    """
+    Print every env.bina_progress_interval seconds the state of the binarizations
+    of an upgrade: the queued, running and finished instances with their elapsed
+    and expected times (their last binarization durations), their last tyr job
+    state and the last line of their tyr log, and an ETA of the whole run
+
+    A binarization taking more than env.bina_stuck_factor times its expected
+    duration is flagged as stuck
+
+    use it as RAII eg:
+    with BinarizationProgress(instances, to_binarize, nb_slots) as progress:
+        progress.start(instance)
+        ...
+        progress.finish(instance, status)
+
+    the processes of the distributed binarizations report to progress.events
+    instead, (instance, 'running' or the final status, timestamp) tuples
+
+    the polling thread runs its commands on the current host with
+    utils.exec_command, never with run whose quiet option would change the
+    global env of the binarizations
+    """
+    def __init__(self, instances, to_binarize, nb_slots):
+        self.host = env.host_string
+        self.states = dict((i, {'status': 'queued'}) for i in instances)
+        self.to_binarize = set(to_binarize)
+        self.nb_slots = max(1, nb_slots)
+        self.expected = {}
+        self.events = multiprocessing.Queue()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.expected = dict((i, float(d)) for i, d in self._query(
+            "select instance.name, extract(epoch from avg(job.updated_at - job.created_at)) "
+            "from instance, job where instance.id = job.instance_id and job.state = 'done' "
+            "group by instance.name;"))
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+
+    def start(self, instance, at=None):
+        self.states[instance] = {'status': 'running', 'start': at or time.time()}
+
+    def finish(self, instance, status, at=None):
+        self.states[instance].update({'status': status, 'end': at or time.time()})
+
+    def _read_events(self):
+        while True:
+            try:
+                instance, status, at = self.events.get_nowait()
+            except Empty:
+                return
+            if status == 'running':
+                self.start(instance, at)
             else:
-                launch_rebinarization(i_name)
+                self.finish(instance, status, at)
 
-    # we run the bina in parallele (if you want sequenciel run, set env.nb_thread_for_bina = 1)
-    with utils.Parallel(env.nb_thread_for_bina) as pool:
-        pool.map(binarize_instance, env.instances.keys())
+    def _query(self, sql):
+        return db.psql_from_thread(self.host, sql, env.tyr_postgresql_database, host=env.postgresql_database_host,
+                                   user=env.tyr_postgresql_user, password=env.tyr_postgresql_password) or []
+
+    def _loop(self):
+        while not self.stopped.wait(env.bina_progress_interval):
+            try:
+                self.display()
+            except Exception as e:
+                print(yellow("WARNING: can't display the binarization progress: {}".format(e)))
+
+    def display(self):
+        self._read_events()
+        now = time.time()
+        jobs = dict((i, state) for i, state in self._query(
+            "select distinct on (instance.name) instance.name, job.state from instance, job "
+            "where instance.id = job.instance_id order by instance.name, job.created_at desc;"))
+        running = [i for i, s in self.states.items() if s['status'] == 'running']
+        logs = {}
+        if running:
+            _, output = utils.exec_command(self.host, "; ".join(
+                'echo "{i}|$(tail -n 1 {d}/{i}.log 2>/dev/null | cut -c1-80)"'.format(i=i, d=env.tyr_base_logdir)
+                for i in running))
+            logs = dict(line.split('|', 1) for line in output.split('\n') if '|' in line)
+        default_expected = sum(self.expected.values()) / len(self.expected) if self.expected else 0
+
+        remaining = 0
+        print(blue("{:<25} {:<10} {:>10} {:>10} {:<10} {}".format('instance', 'status', 'elapsed',
+                                                                  'expected', 'last job', 'tyr log')))
+        for instance, state in sorted(self.states.items(), key=lambda x: (x[1]['status'], x[0])):
+            expected = self.expected.get(instance, default_expected) if instance in self.to_binarize else 0
+            elapsed = int(state.get('end', now) - state['start']) if 'start' in state else 0
+            color = green
+            if state['status'] == 'running':
+                color = blue
+                remaining += max(0, expected - elapsed)
+                if expected and elapsed > env.bina_stuck_factor * expected:
+                    color = red
+            elif state['status'] == 'queued':
+                color = yellow
+                remaining += expected
+            elif state['status'] == 'failed':
+                color = red
+            print(color("{:<25} {:<10} {:>10} {:>10} {:<10} {}".format(
+                instance, state['status'] + ('!' if color == red else ''),
+                datetime.timedelta(seconds=elapsed), datetime.timedelta(seconds=int(expected)),
+                jobs.get(instance, ''), logs.get(instance, ''))))
+        print(blue("ETA: {}".format(datetime.timedelta(seconds=int(remaining / self.nb_slots)))))
+
+
+def get_bina_version():
+    """ Return the version of navitia-ed used by the binarizations
+    """
+    version = run("dpkg-query -W -f='${Version}' navitia-ed", quiet=True)
+    return version.strip() if version.succeeded and version.strip() else 'unknown'
+
+
+def get_bina_run_key():
+    """ Return the (platform, tyr_master host, navitia-ed version) tuple
+        identifying the binarizations of an upgrade in env.bina_checkpoint_file
+    """
+    return env.name, env.roledefs['tyr_master'][0], get_bina_version()
+
+
+def _read_bina_checkpoint():
+    """ Return the (run key, instance, status) of the local env.bina_checkpoint_file """
+    if not os.path.exists(env.bina_checkpoint_file):
+        return []
+    with open(env.bina_checkpoint_file) as f:
+        return [(tuple(fields[:3]), fields[3], fields[4]) for fields in (line.split() for line in f)
+                if len(fields) == 5]
 
-    start_tyr_beat()
+
+def get_bina_checkpoint(run_key):
+    """ Return a dict {instance: status} of the instances already done for this
+        platform, tyr_master and navitia-ed version (see get_bina_run_key)
+    """
+    return dict((i_name, status) for key, i_name, status in _read_bina_checkpoint()
+                if key == run_key and status in ('rebuilt', 'skipped'))
+
+
+def reset_bina_checkpoint(run_key):
+    """ Forget the instances done for the platform and tyr_master of run_key,
+        keeping the ones of the other platforms
+    """
+    lines = [' '.join(key + (i_name, status)) for key, i_name, status in _read_bina_checkpoint()
+             if key[:2] != run_key[:2]]
+    with open(env.bina_checkpoint_file, 'w') as f:
+        f.writelines(line + '\n' for line in lines)
+
+
+def _binarize_instance(i_name, changed=True, run_key=None):
+    """ Binarize an instance if needed
+        If run_key, the result is recorded in env.bina_checkpoint_file
+        Return the tuple (instance name, 'rebuilt'|'skipped'|'excluded'|'failed')
+    """
+    status = _do_binarize_instance(i_name, changed)
+    if run_key:
+        # a single small write in append mode is atomic, even from the distributed workers
+        with open(env.bina_checkpoint_file, 'a') as f:
+            f.write(' '.join(run_key + (i_name, status)) + '\n')
+    return i_name, status
+
+
+def _do_binarize_instance(i_name, changed):
+    """ Return the status of the binarization of the instance
+    """
+    with utils.time_that(blue("data loaded for " + i_name + " in {elapsed}")):
+        print(blue("loading data for {}".format(i_name)))
+
+        if i_name in env.excluded_instances:
+            print(blue("NOTICE: i_name {} has been excluded, skiping it".format(i_name)))
+            return 'excluded'
+        if not changed:
+            print(blue("NOTICE: inputs of {} did not change since its last binarization, skiping it"
+                       .format(i_name)))
+            return 'skipped'
+        # the data of the engines are refreshed by upgrade_kraken, not from the threads
+        return 'rebuilt' if launch_rebinarization(i_name, distribute=False) else 'failed'
+
+
+@parallel
+def _binarization_worker(queue, events):
+    """ Binarize the instances of the queue on the current tyr host, in
+        env.tyr_bina_slots[host] (default env.nb_thread_for_bina) threads,
+        reporting their progress to the events queue (see BinarizationProgress)
+    """
+    nb_slots = env.tyr_bina_slots.get(env.host_string, env.nb_thread_for_bina)
+    statuses = []
+
+    def slot(_):
+        while True:
+            try:
+                job = queue.get(timeout=1)
+            except Empty:
+                return
+            events.put((job[0], 'running', time.time()))
+            i_name, status = _binarize_instance(*job)
+            events.put((i_name, status, time.time()))
+            statuses.append((i_name, status))
+
+    with utils.Parallel(nb_slots) as pool:
+        pool.map(slot, range(nb_slots))
+    return statuses
 
 
 @task
 @roles('tyr_master')
-def launch_rebinarization(instance):
+def launch_rebinarization(instance, distribute=True):
     """ Re-launch binarization of previously processed input data
         During upgrade, we need to regenerate data.nav.lz4 file because of
         serialization objects changes; we have to find the last input file
         processed
+        Unless env.datanav_distribution is 'shared', the new data.nav.lz4 is then
+        pushed to the engines if distribute (the upgrade leaves it to upgrade_kraken)
+        Return True if the binarization succeeded
     """
     if env.dry_run is True:
         print("DRY-RUN: cd /srv/tyr/ "
@@ -432,52 +1076,41 @@ def launch_rebinarization(instance):
         with cd(env.tyr_basedir), shell_env(TYR_CONFIG_FILE=env.tyr_settings_file), settings(user=env.KRAKEN_USER):
             print(blue("NOTICE: launching binarization on {} @{}".format(instance, time.strftime('%H:%M:%S'))))
             try:
-                run("python manage.py import_last_dataset {i}".format(i=instance))
-            except:
+                result = run("python manage.py import_last_dataset {i}".format(i=instance))
+            except SystemExit:
+                # the failure aborts the task, unless warn_only
+                result = None
+            if result is None or result.failed:
                 print(red("ERROR: failed binarization on {}".format(instance)))
+                return False
+        if env.datanav_generations:
+            snapshot_datanav(instance)
+        if utils.get_bool_from_cli(distribute) and env.datanav_distribution != 'shared':
+            kraken.distribute_datanav(instance)
+        return True
 
 @task
 @roles('db')
 def get_instance_id(instance):
     """ Return the id of a given instance """
-
-    _upload_template("templates/db/instance_id.sql.jinja",
-            "/var/lib/postgresql/postgres_{}.sql".format(instance),
-            use_jinja=True,
-            context={'instance': instance},
-    )
-    instance_id = run('su - postgres --command="psql {} --quiet --tuples-only < /var/lib/postgresql/postgres_{}.sql"'
-            .format(env.jormungandr_postgresql_database, instance))
-    run("rm -f /var/lib/postgresql/postgres_{}.sql".format(instance))
-    return instance_id
+    rows = db.jormungandr_query(utils._render_template("db/instance_id.sql.jinja"), {'instance': instance})
+    return rows[0][0] if rows else None
 
 @task
 @roles('db')
 def get_tyr_last_done_job_id(instance_id):
     """ Return the last done job for an instance """
-    _upload_template("templates/db/last-job-instance.sql.jinja",
-            "/var/lib/postgresql/postgres_{}.sql".format(instance_id),
-            use_jinja=True,
-            context={'instance_id': instance_id},
-    )
-    job_id = run('su - postgres --command="psql {} --quiet --tuples-only < /var/lib/postgresql/postgres_{}.sql"'
-            .format(env.jormungandr_postgresql_database, instance_id))
-    run("rm -f /var/lib/postgresql/postgres_{}.sql".format(instance_id))
-    return job_id
+    rows = db.jormungandr_query(utils._render_template("db/last-job-instance.sql.jinja"),
+                                {'instance_id': instance_id})
+    return rows[0][0] if rows else None
 
 @task
 @roles('db')
 def get_tyr_last_pt_data_set(instance_id):
     """Return the data_set used for """
-    _upload_template("templates/db/job-id-data-set.sql.jinja",
-            "/var/lib/postgresql/postgres_{}.sql".format(instance_id),
-            use_jinja=True,
-            context={'instance_id': instance_id},
-    )
-    data_set = run('su - postgres --command="psql {} --quiet --tuples-only < /var/lib/postgresql/postgres_{}.sql"'
-            .format(env.jormungandr_postgresql_database, instance_id))
-    run("rm -f /var/lib/postgresql/postgres_{}.sql".format(instance_id))
-    return data_set
+    rows = db.jormungandr_query(utils._render_template("db/job-id-data-set.sql.jinja"),
+                                {'instance_id': instance_id})
+    return rows[0][0] if rows else None
 
 
 @task
@@ -516,11 +1149,17 @@ def test_tyr_backup_file_presence():
 @task
 @roles('tyr')
 def update_tyr_instance_conf(instance):
+    if env.datanav_generations:
+        utils.require_directories([os.path.dirname(instance.tyr_target_file), instance.datanav_generations_dir],
+                                  is_on_nfs4=True, owner=env.KRAKEN_USER, group=env.KRAKEN_USER, use_sudo=True)
+    postgresql_host, postgresql_port = pgbouncer.get_client_address()
     _upload_template("tyr/instance.ini.jinja",
                      "{}/{}.ini".format(env.tyr_base_instances_dir, instance.name),
                      context={
                          'env': env,
                          'instance': instance,
+                         'postgresql_host': postgresql_host,
+                         'postgresql_port': postgresql_port,
                      },
     )
 
@@ -546,16 +1185,17 @@ def update_tyr_instance_conf(instance):
 
 @task
 @roles('tyr')
-def create_tyr_instance(instance):
+def create_tyr_instance(instance, create_db=True):
     """ Create a *private* tyr instance based on the given name
-        * postgresql user + dedicated database (1 time)
+        * postgresql user + dedicated database (1 time), unless not create_db
         * /etc/tyr.d/instance.ini
         * create /srv/ed/<instance> + target-file basedir
     """
     # postgresql user + dedicated database
     # we create a user and a db if they does not exists
     # TODO: this is potentially executed multiple times !
-    execute(db.create_instance_db, instance)
+    if utils.get_bool_from_cli(create_db):
+        execute(db.create_instance_db, instance)
 
     # /srv/ed/destination/$instance & /srv/ed/backup/$instance
     utils.require_directory(instance.base_ed_dir,
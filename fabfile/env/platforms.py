@@ -151,6 +151,20 @@ env.jormungandr_broker_password = 'guest'
 # Note: only production need to override this
 env.jormungandr_instance_socket = 'localhost'
 
+# apache access log of jormungandr, used to replay real requests
+env.jormungandr_access_log = '/var/log/apache2/jormungandr-access.log'
+
+# warm up the krakens before putting a ws node back in the load balancer by
+# replaying a sample of recent journeys and places requests, by rounds, until
+# the median latency varies by less than warm_up_stability between two rounds
+env.warm_up_krakens = False
+env.warm_up_nb_requests = 200
+env.warm_up_concurrency = 4
+env.warm_up_max_rounds = 5
+env.warm_up_stability = 0.1
+# timeout (in s) of the requests replayed by the warm up and the bench
+env.jormungandr_request_timeout = 30
+
 env.jormungandr_default_handler = 'default'
 env.jormungandr_syslog_facility = 'local7'
 
@@ -190,6 +204,10 @@ env.kraken_log_max_size = 20
 env.kraken_syslog_facility = 'local7'
 env.kraken_syslog_ident = 'kraken'
 
+# expected yearly growth of the data (and so of the krakens memory), used to
+# project the hosts headroom in the capacity report
+env.capacity_growth_rate = 0.2
+
 # We use apache wsgi to monitor kraken
 env.kraken_monitor_port = 80
 env.kraken_monitor_location_dir = 'monitor-kraken'
@@ -235,6 +253,17 @@ env.tyr_postgresql_database = 'jormungandr'
 env.tyr_postgresql_user = 'jormungandr'
 env.tyr_postgresql_password = 'jormungandr'
 
+# number of binarizations a tyr worker runs at the same time and max memory
+# (in kB) of a worker process, computed from the cores and memory of each tyr
+# host when None
+env.tyr_worker_concurrency = None
+env.tyr_worker_max_memory_per_child = None
+# the max memory needs celery >= 4, with celery 3 a worker process is replaced
+# after this number of binarizations instead
+env.tyr_worker_max_tasks_per_child = 1
+# memory (in kB) needed by a binarization, used to compute the worker concurrency
+env.tyr_bina_memory_kb = 4 * 1024 * 1024
+
 # redis
 env.tyr_redis_password = None
 # index of the database use in redis, between 0 and 15 by default
@@ -251,12 +280,125 @@ env.token = ''
 #parameter to allow fabric to kill old tyr worker still alive after service stop
 env.kill_ghost_tyr_worker = True
 
+# drain the tyr workers, in parallel, before stopping them: they stop taking new
+# jobs and the running and reserved ones are given tyr_worker_drain_timeout
+# seconds to finish, the jobs left at the deadline are killed and listed to be
+# re-queued
+env.drain_tyr_worker = False
+env.tyr_worker_drain_timeout = 1800
+# seconds between two progress reports of the drain
+env.tyr_worker_drain_poll = 30
+# run the queries on the jormungandr database locally with a pool of
+# db_pool_size psycopg2 connections instead of a remote psql for each one,
+# through an ssh tunnel to the first db host if db_pool_tunnel, else directly
+# (ex: for a local PostgreSQL)
+env.use_db_connection_pool = False
+env.db_pool_tunnel = True
+env.db_pool_size = 4
+env.postgresql_database_port = 5432
+
+# PostgreSQL settings overriding the ones derived from the RAM and cores of the db
+# host by db.tune_db (ex: {'work_mem': '64MB'})
+env.postgresql_tuning = {}
+# pgbench run by tune_db:bench=True on the postgresql_bench_database database
+env.postgresql_bench_database = 'fabric_bench'
+env.postgresql_bench_scale = 10
+env.postgresql_bench_duration = 30
+
+# mod_wsgi daemon processes and threads of jormungandr and tyr
+env.jormungandr_wsgi_processes = 1
+env.jormungandr_wsgi_threads = 15
+env.tyr_wsgi_processes = 1
+env.tyr_wsgi_threads = 15
+# SQLAlchemy pool of connections of each jormungandr and tyr process, None for
+# at most one connection by wsgi thread, a third of them in overflow
+env.jormungandr_db_pool_size = None
+env.jormungandr_db_max_overflow = None
+env.tyr_db_pool_size = None
+env.tyr_db_max_overflow = None
+# seconds before a pooled connection is replaced, and check of the connections
+# before use (needs SQLAlchemy >= 1.2 and Flask-SQLAlchemy >= 2.4)
+env.db_pool_recycle = 3600
+env.db_pool_pre_ping = False
+
+# connect jormungandr, tyr, ed and the chaos databases of kraken to PostgreSQL
+# through pgbouncer in pgbouncer_pool_mode, on the db host or, if
+# pgbouncer_colocated, on each host (listening on localhost); the ed schema
+# migrations keep connecting directly
+env.use_pgbouncer = False
+env.pgbouncer_colocated = False
+env.pgbouncer_port = 6432
+env.pgbouncer_pool_mode = 'transaction'
+env.pgbouncer_max_client_conn = 1000
+# server connections by database and user, plus the reserve used when clients wait
+env.pgbouncer_default_pool_size = 20
+env.pgbouncer_reserve_pool_size = 5
+# server connections by database and by user whatever their pools, 0 for no limit
+env.pgbouncer_max_db_connections = 0
+env.pgbouncer_max_user_connections = 0
+# databases pooled in session mode, for the clients needing session features
+# (prepared statements, temporary tables, advisory locks...), ex: an ed database
+env.pgbouncer_session_databases = []
+
+# template database of the ed databases, with postgis and the ed schema
+# (owned by ed_template_user) installed, the databases of the new instances
+# are copies of it; set to None to create them empty
+env.ed_template_database = 'template_ed'
+env.ed_template_user = 'template_ed'
+# password of ed_template_user, no template is used until it is set
+env.ed_template_password = None
+
+# celery queue consumed by the tyr workers
+env.tyr_worker_queue = 'celery'
+
 # default is to do things
 env.dry_run = False
 
 #number of parallele binarization
 env.nb_thread_for_bina = 1
 
+# during an upgrade, adjust every bina_adapt_interval seconds the number of
+# parallele binarizations (starting at nb_thread_for_bina) between
+# bina_min_concurrency and bina_max_concurrency: one more while the db and
+# tyr_master hosts are below the thresholds, half as many when one is above
+env.adaptive_bina = False
+env.bina_min_concurrency = 1
+env.bina_max_concurrency = 8
+env.bina_adapt_interval = 60
+# thresholds: load average per core, ratio of cpu time in iowait, ratio of available memory
+env.bina_max_load = 1.5
+env.bina_max_iowait = 0.3
+env.bina_min_mem_available = 0.1
+
+# VACUUM ANALYZE the ed database of each instance rebuilt by an upgrade, with
+# at most nb_thread_for_vacuum vacuums at a time (also used by db.vacuum_ed_dbs)
+env.vacuum_after_bina = False
+env.nb_thread_for_vacuum = 2
+
+# seconds between two displays of the binarizations progress during an upgrade
+env.bina_progress_interval = 60
+# a binarization taking more than bina_stuck_factor times its usual duration is flagged
+env.bina_stuck_factor = 2
+
+# local file recording the instances binarized by launch_rebinarization_upgrade
+# for each platform, tyr_master and navitia-ed version, used to resume an
+# interrupted run (resume=True)
+env.bina_checkpoint_file = os.path.expanduser('~/.fabric_navitia_rebinarization.checkpoint')
+
+# max number of ed databases upgraded at the same time
+env.nb_thread_for_ed_migration = 4
+
+# binarize the instances on all the tyr hosts during an upgrade, each host
+# taking the next instance as soon as one of its slots is free
+env.distributed_bina = False
+# number of binarization slots by tyr host (ex: {'root@tyr2': 4}),
+# nb_thread_for_bina for the hosts not given
+env.tyr_bina_slots = {}
+
+# during an upgrade, do not binarize again the instances whose last data_sets,
+# ed schema and navitia-ed version are the same as at their last binarization
+env.skip_unchanged_binarization = True
+
 #instances configurations
 env.instances = {}
 
@@ -267,6 +409,35 @@ env.tyr_destination_dir_template = '{base}/destination'
 
 env.kraken_database_file = '{base_dest}/{instance}/data.nav.lz4'
 
+# how the data.nav.lz4 produced by tyr reach the engines:
+#  'shared': the engines read it in tyr_base_destination_dir (usually on nfs)
+#  'chain': tyr pushes it to the engines local dir through a pipelined chain
+#           tyr -> eng1 -> eng2 -> ..., each hop forwarding while receiving
+#           (also needs ssh access between the engines)
+#  'rsync': tyr sends to each engine only the blocks that changed since the
+#           previous data
+# both need env.datanav_generations, so that the datanav_publisher cron pushes
+# the binarizations scheduled by tyr, and ssh access from tyr_master to the
+# engines as env.KRAKEN_USER
+env.datanav_distribution = 'shared'
+
+# use rsync delta transfer instead of full copies for the data.nav.lz4 backups
+env.use_delta_sync = False
+
+# the data.nav.lz4 backups are reflinks when the filesystem allows it, else copies
+# max number of data.nav.lz4 backed up at the same time
+env.nb_thread_for_backup = 4
+
+# if > 0, the data.nav.lz4 of an instance is a symlink to one of its last
+# datanav_generations generations of data, a backup is then a snapshot of the
+# current data and a rollback an atomic switch of the symlink
+# tyr then writes to a staging file, published as a new generation by the
+# datanav_publisher script of the tyr hosts, run every minute by cron on
+# tyr_master for the binarizations scheduled by tyr, and by fabric after its
+# own binarizations
+env.datanav_generations = 0
+env.datanav_publisher = os.path.join(env.tyr_basedir, 'publish_datanav.sh')
+
 #in general we don't want to configure apache
 env.setup_apache = False
 
@@ -77,14 +77,29 @@ class Instance:
     def target_lz4_file(self):
         return "{base_dest}/{instance}/data.nav.lz4".format(base_dest=env.tyr_base_destination_dir, instance=self.name)
 
+    @property
+    def tyr_target_file(self):
+        # with generations, tyr writes a plain staging file moved into a new
+        # generation by tyr.snapshot_datanav, never the file of a generation
+        if env.datanav_generations:
+            return "{}/staging/data.nav.lz4".format(self.base_destination_dir)
+        return self.target_lz4_file
+
     @property
     def kraken_database(self):
+        if env.datanav_distribution != 'shared':
+            # the engines read their own local copy of the data
+            return "{}/{}".format(self.kraken_basedir, env.kraken_data_nav)
         return env.kraken_database_file.format(base_dest=env.tyr_base_destination_dir, instance=self.name, ed_basedir=env.ed_basedir)
 
     @property
     def base_destination_dir(self):
         return "{base_dest}/{instance}".format(base_dest=env.tyr_base_destination_dir, instance=self.name)
 
+    @property
+    def datanav_generations_dir(self):
+        return "{}/generations".format(self.base_destination_dir)
+
     @property
     def target_tmp_file(self):
         return "{base}/{instance}/datatmp.nav.lz4".format(base=env.ed_basedir, instance=self.name)
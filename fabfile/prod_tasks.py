@@ -93,6 +93,12 @@ def restart_jormungandr(nodes, safe=True):
     for node in nodes:
         execute(jormungandr.reload_jormun_safe, node, safe)
 
+@task
+def warm_up_nodes(nodes):
+    if env.warm_up_krakens:
+        for node in nodes:
+            execute(jormungandr.warm_up_krakens, node)
+
 @task
 def switch_to_first_phase(eng_hosts_1, ws_hosts_1, ws_hosts_2):
     execute(disable_nodes, eng_hosts_1)
@@ -106,11 +112,14 @@ def switch_to_second_phase(eng_hosts_1, eng_hosts_2, ws_hosts_1,  ws_hosts_2):
     execute(disable_nodes, eng_hosts_2)
     # then enable / disable jormun nodes and restart active jormun nodes
     execute(restart_jormungandr, ws_hosts_1, safe=False)
+    execute(warm_up_nodes, ws_hosts_1)
     execute(enable_nodes, ws_hosts_1)
     execute(disable_nodes, ws_hosts_2)
 
 @task
 def enable_all_nodes(eng_hosts, ws_hosts_1,  ws_hosts_2):
     execute(enable_nodes, eng_hosts)
-    execute(restart_jormungandr, ws_hosts_2)
+    execute(restart_jormungandr, ws_hosts_2, safe=False)
+    execute(warm_up_nodes, ws_hosts_2)
+    execute(enable_nodes, ws_hosts_2)
     execute(restart_jormungandr, ws_hosts_1)
@@ -31,12 +31,13 @@
 
 import datetime
 import os
+from pipes import quote
 
 from fabric.api import run, env, task, execute, roles
 from fabric.colors import blue, red, yellow, green
 from fabric.contrib.files import exists
 
-from fabfile.component import tyr, db, jormungandr, kraken
+from fabfile.component import tyr, db, jormungandr, kraken, pgbouncer
 from fabfile.component.kraken import upgrade_monitor_kraken_packages
 from fabfile.component.load_balancer import get_adc_credentials
 from fabfile import utils
@@ -70,8 +71,11 @@ def setup():
     """
     execute(upgrade_all_packages)
     execute(db.setup_db)
+    if env.use_pgbouncer:
+        execute(pgbouncer.setup_pgbouncer)
     execute(tyr.setup_tyr)
     execute(tyr.setup_tyr_master)
+    execute(tyr.update_ed_template)
     execute(kraken.setup_kraken)
     execute(jormungandr.setup_jormungandr)
     execute(tyr.upgrade_db_tyr)
@@ -142,6 +146,7 @@ def upgrade_tyr(up_confs=True):
         execute(tyr.update_tyr_conf)
         for instance in env.instances.values():
             execute(tyr.update_tyr_instance_conf, instance)
+        execute(tyr.update_datanav_publisher)
     restart_tyr()
 
 @task
@@ -179,8 +184,7 @@ def upgrade_version():
     # upgrade packages anywhere
     execute(upgrade_all_packages)
     execute(upgrade_tyr)
-    for instance in env.instances.values():
-        execute(tyr.update_ed_db, instance.name)
+    execute(tyr.update_all_ed_db)
 
 @task
 def upgrade_kraken(kraken_wait=True, up_confs=True):
@@ -188,6 +192,8 @@ def upgrade_kraken(kraken_wait=True, up_confs=True):
     kraken_wait = get_bool_from_cli(kraken_wait)
     execute(kraken.upgrade_engine_packages)
     execute(kraken.upgrade_monitor_kraken_packages)
+    if env.datanav_distribution != 'shared':
+        execute(kraken.distribute_all_datanav)
     execute(kraken.restart_all_krakens, wait=kraken_wait)
     if up_confs:
         execute(kraken.update_monitor_configuration)
@@ -211,6 +217,14 @@ def upgrade_jormungandr(reload=True, up_confs=True):
 def isset_dataset(filename=None):
     return exists(filename)
 
+@task
+@roles("tyr_master")
+def isset_datasets(filenames):
+    """ Return the subset of the given files which exist, in one remote call """
+    output = run('for f in {}; do test -e "$f" && echo "$f"; done; true'
+                 .format(' '.join(quote(f) for f in filenames)))
+    return set(line.strip() for line in output.split('\n') if line.strip())
+
 @task
 @roles("db")
 def check_last_dataset():
@@ -218,44 +232,41 @@ def check_last_dataset():
     datasets_pending = {}
     datasets = {'ok': [], 'ko': [], 'pending': [], 'empty': []}
     nb_ko = 0
+    if not env.instances:
+        print(yellow("WARNING: no instance to check"))
+        return
 
     date_stopchecking = datetime.datetime.now() - datetime.timedelta(days=10)
     str_date = date_stopchecking.strftime("%Y-%m-%d")
 
+    # the last done and recent pending data_set of each type for all instances in one query
+    rows = db.jormungandr_query(utils._render_template("db/last-datasets.sql.jinja"),
+                                {'instances': tuple(env.instances.keys()), 'pending_since': str_date})
+    done = {}
+    pending = {}
+    for name, state, fil, typ, dat in rows:
+        (done if state == 'done' else pending).setdefault(name, []).append((fil, typ, dat))
+
+    all_files = [fil for data_sets in done.values() for fil, _, _ in data_sets]
+    existing_files = execute(isset_datasets, all_files).values()[0] if all_files else set()
+
     for instance in env.instances.values():
         datasets_pending[instance.name] = []
-        res = run('sudo -i -u postgres psql -A -t -c '
-              '"select distinct on (data_set.family_type) data_set.name, data_set.family_type '
-              '  from instance, job, data_set '
-              '  where instance.id = job.instance_id and job.id = data_set.job_id and instance.name=\'%s\' and job.state=\'done\' '
-              '  order by data_set.family_type desc, job.created_at desc;" jormungandr' % instance.name)
-        arr_dataset = res.split('\n')
-        for dataset in arr_dataset:
-            if dataset != "":
-                fil, typ = dataset.split("|")
-                filname = os.path.split(fil)[1]
-                isset = execute(isset_dataset, fil)
-                if not isset:
-                    datasets['ko'].append({'instance': instance.name, 'file': fil, 'type': typ, 'filename': filname})
-                    nb_ko += 1
-                else:
-                    datasets['ok'].append({'instance': instance.name, 'file': fil, 'type': typ, 'filename': filname})
+        if instance.name not in done:
+            datasets['empty'].append(instance.name)
+        for fil, typ, _ in done.get(instance.name, []):
+            filname = os.path.split(fil)[1]
+            if fil not in existing_files:
+                datasets['ko'].append({'instance': instance.name, 'file': fil, 'type': typ, 'filename': filname})
+                nb_ko += 1
             else:
-                datasets['empty'].append(instance.name)
-
-        res = run('sudo -i -u postgres psql -A -t -c '
-              '"select distinct on (data_set.family_type) data_set.name, data_set.family_type, job.created_at '
-              '  from instance, job, data_set '
-              '  where instance.id = job.instance_id and job.id = data_set.job_id and instance.name=\'{}\' and job.state=\'pending\' and job.created_at > \'{}\' '
-              '  order by data_set.family_type desc, job.created_at desc;" jormungandr'.format(instance.name, str_date))
-        arr_dataset = res.split('\n')
-        for dataset in arr_dataset:
-            if dataset != "":
-                (fil, typ, dat) = dataset.split("|")
-                filname = os.path.split(fil)[1]
-                datasets['pending'].append({'instance': instance.name, 'file': fil, 'type': typ,
-                                            'filename': filname, 'date': dat})
-                datasets_pending[instance.name].append(filname)
+                datasets['ok'].append({'instance': instance.name, 'file': fil, 'type': typ, 'filename': filname})
+
+        for fil, typ, dat in pending.get(instance.name, []):
+            filname = os.path.split(fil)[1]
+            datasets['pending'].append({'instance': instance.name, 'file': fil, 'type': typ,
+                                        'filename': filname, 'date': dat})
+            datasets_pending[instance.name].append(filname)
 
     if len(datasets['ok']):
         print("******** AVAILABLE DATASETS ********")
@@ -271,7 +282,7 @@ def check_last_dataset():
     if len(datasets['pending']):
         print("********* PENDING DATASETS *********")
         for data in datasets['pending']:
-            print(yellow(data['file'] + " since " + data['date']))
+            print(yellow("{} since {}".format(data['file'], data['date'])))
     if len(datasets['empty']):
         print("********** EMPTY DATASETS **********")
         for data in datasets['empty']:
@@ -295,8 +306,13 @@ def update_all_instances(kraken_wait=True):
     """
     kraken_wait = get_bool_from_cli(kraken_wait)
     print(blue('creating all instances'))
+    # the users, databases and postgis of all the instances at once
+    execute(db.create_all_instance_dbs, env.instances.values())
+    if env.use_pgbouncer:
+        execute(pgbouncer.update_pgbouncer_conf)
     for instance in env.instances.values():
-        execute(update_instance, instance)
+        execute(update_instance, instance, create_db=False)
+    execute(tyr.update_datanav_publisher)
     execute(kraken.restart_all_krakens, wait=kraken_wait)
 
 @task
@@ -309,10 +325,13 @@ def update_all_configurations():
     execute(jormungandr.update_jormungandr_conf)
     execute(kraken.update_monitor_configuration)
     execute(tyr.update_tyr_conf)
+    if env.use_pgbouncer:
+        execute(pgbouncer.update_pgbouncer_conf)
     for instance in env.instances.values():
         execute(tyr.update_tyr_instance_conf, instance)
         execute(jormungandr.deploy_jormungandr_instance_conf, instance)
         execute(kraken.update_eng_instance_conf, instance)
+    execute(tyr.update_datanav_publisher)
     #once all has been updated, we restart all services for the conf to be taken into account
     execute(tyr.restart_tyr_worker)
     execute(tyr.restart_tyr_beat)
@@ -324,17 +343,24 @@ def update_all_configurations():
         jormungandr.test_jormungandr(utils.get_host_addr(server))
 
 @task
-def update_instance(instance):
+def update_instance(instance, create_db=True):
     """
     param (instance) - update all configuration and restart all services
     does not deploy any packages
+    param (create_db) - create the database of the instance if needed
     """
     instance = utils.get_real_instance(instance)  # since it might be a endpoint we might need to get the real instance
     print(blue('updating {}'.format(instance.name)))
     #first of all we compute the instance status, it will be helpfull later
     execute(utils.compute_instance_status, instance)
-    execute(tyr.create_tyr_instance, instance)
-    execute(db.postgis_initdb, instance.db_name)
+    create_db = get_bool_from_cli(create_db)
+    execute(tyr.create_tyr_instance, instance, create_db=create_db)
+    execute(tyr.update_datanav_publisher)
+    if create_db:
+        execute(db.postgis_initdb, instance.db_name)
+        if env.use_pgbouncer:
+            # the user of the instance
+            execute(pgbouncer.update_pgbouncer_conf)
     execute(tyr.update_ed_db, instance.name)
     execute(jormungandr.deploy_jormungandr_instance_conf, instance)
     execute(kraken.create_eng_instance, instance)
@@ -38,13 +38,16 @@ import os
 import random
 from retrying import Retrying, RetryError
 import string
+import threading
 import time
 
-from fabric.colors import green, yellow, red
+from fabric.colors import green, yellow, red, blue
 from fabric.context_managers import cd
 from fabric.api import env, task, roles, run, put, sudo, warn_only, execute
 from fabric.contrib.files import exists
+from fabric.state import connections
 from fabtools.files import upload_template
+from jinja2 import Environment, FileSystemLoader
 from fabtools import require
 from fabtools.require.files import temporary_directory
 
@@ -150,12 +153,113 @@ def _upload_template(filename, destination, context=None, chown=True, user='www-
     upload_template(filename, destination, **kwargs)
 
 
+def _render_template(filename, context=None):
+    """
+    return the content of a template of the templates directory rendered with jinja
+    """
+    template_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, 'templates')
+    return Environment(loader=FileSystemLoader(template_dir)).get_template(filename).render(**(context or {}))
+
+
+def get_db_pool_context(component):
+    """
+    return the template context of the SQLAlchemy pool of the processes of a
+    component ('jormungandr' or 'tyr'), derived from its wsgi threads unless
+    forced by env.<component>_db_pool_size and env.<component>_db_max_overflow
+
+    a thread holds at most one connection, so by default pool_size + max_overflow
+    is the number of threads, a third of them being overflow connections closed
+    when idle
+    """
+    threads = env[component + '_wsgi_threads']
+    max_overflow = env[component + '_db_max_overflow']
+    pool_size = env[component + '_db_pool_size'] or threads - (threads // 3 if max_overflow is None else max_overflow)
+    if max_overflow is None:
+        max_overflow = max(0, threads - pool_size)
+    return {
+        'db_pool_size': max(1, pool_size),
+        'db_max_overflow': max_overflow,
+    }
+
+
+def get_tyr_worker_resources():
+    """
+    return the concurrency and max memory (in kB) by process of the tyr worker of
+    the current host, fitted to its cores and memory unless forced by
+    env.tyr_worker_concurrency and env.tyr_worker_max_memory_per_child
+    """
+    concurrency = env.tyr_worker_concurrency
+    max_memory = env.tyr_worker_max_memory_per_child
+    if not concurrency or not max_memory:
+        resources = get_host_resources()
+        # binarization is memory bound, we keep 20% of the memory for the system
+        usable_memory = resources['mem_total_kb'] * 8 / 10
+        concurrency = concurrency or max(1, min(resources['cores'], usable_memory / env.tyr_bina_memory_kb))
+        max_memory = max_memory or usable_memory / concurrency
+    return {
+        'tyr_worker_concurrency': concurrency,
+        'tyr_worker_max_memory_per_child': max_memory,
+    }
+
+
 def get_psql_version():
     version_lines = run('psql --version')
     v_line = version_lines.split('\n')[0]
     return v_line.split(" ")[-1].split(".")
 
 
+def delta_sync_command(source, destination, inplace=False):
+    """
+    return the rsync command of delta_sync
+    """
+    return "rsync --no-whole-file --copy-links --stats {inplace} -e 'ssh -o BatchMode=yes' {src} {dest}".format(
+        inplace='--inplace' if inplace else '', src=source, dest=destination)
+
+
+def delta_sync(source, destination, inplace=False, use_sudo=False):
+    """
+    copy source to destination with the rsync rolling checksum algorithm, only
+    the blocks that differ from the previous destination file are transferred
+
+    destination can be on another host ('user@host:path'), the current host then
+    needs a ssh access to it
+
+    with inplace the unchanged blocks of destination are not even rewritten, do not use
+    it on a file being read (a kraken database for example)
+
+    return the tuple (bytes transferred, file size)
+    """
+    cmd = sudo if use_sudo else run
+    output = cmd(delta_sync_command(source, destination, inplace))
+    stats = {}
+    for line in output.split('\n'):
+        key, sep, value = line.partition(':')
+        if sep and value.strip():
+            stats[key.strip()] = value.strip().split()[0].replace(',', '')
+    transferred = int(stats.get('Literal data', 0))
+    size = int(stats.get('Total file size', 0))
+    print(green("{} -> {}: {} bytes transferred for a {} bytes file ({:.1%})".format(
+        source, destination, transferred, size, float(transferred) / size if size else 0)))
+    return transferred, size
+
+
+def get_host_resources():
+    """
+    return the number of cores and the total and available memory (in kB) of the current host
+    """
+    meminfo = {}
+    for line in run("cat /proc/meminfo").split('\n'):
+        key, sep, value = line.partition(':')
+        if sep:
+            meminfo[key.strip()] = int(value.split()[0])
+    return {
+        'cores': int(run('nproc')),
+        'mem_total_kb': meminfo['MemTotal'],
+        # MemAvailable is only given by kernels >= 3.14
+        'mem_available_kb': meminfo.get('MemAvailable', meminfo['MemFree'] + meminfo.get('Cached', 0)),
+    }
+
+
 def get_host_addr(host):
     """
     get the address of the server from the ssh connection string
@@ -188,7 +292,114 @@ class Parallel:
         self.pool.join()
 
     def map(self, func, param):
-        self.pool.map(func, param)
+        return self.pool.map(func, param)
+
+    def apply_async(self, func, *args):
+        return self.pool.apply_async(func, args)
+
+
+class AdaptiveParallel(Parallel):
+    """
+    run job in multi thread, with a number of concurrent jobs adjusted between
+    min_thread and max_thread (AIMD): every interval seconds, overloaded() is
+    called, if it returns a reason the limit is halved, else it is increased by
+    one if all the allowed jobs are running
+
+    use it as RAII eg:
+    with AdaptiveParallel(1, 8, overloaded) as p:
+        p.map(my_function, my_param_array)
+    """
+    def __init__(self, min_thread, max_thread, overloaded, start=None, interval=60):
+        Parallel.__init__(self, max_thread)
+        self.min_thread, self.max_thread = min_thread, max_thread
+        self.limit = max(min_thread, min(max_thread, start or min_thread))
+        self.running = 0
+        self.overloaded = overloaded
+        self.interval = interval
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.controller = threading.Thread(target=self._control)
+        self.controller.daemon = True
+
+    def __enter__(self):
+        self.controller.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        self.controller.join()
+        Parallel.__exit__(self, exc_type, exc_val, exc_tb)
+
+    def _control(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                reason = self.overloaded()
+            except Exception as e:
+                print(yellow("WARNING: can't sample the load: {}".format(e)))
+                continue
+            with self.condition:
+                if reason:
+                    limit = max(self.min_thread, self.limit // 2)
+                elif self.running >= self.limit:
+                    limit = min(self.max_thread, self.limit + 1)
+                else:
+                    limit = self.limit
+                if limit != self.limit:
+                    print(blue("concurrency {} -> {} ({})".format(self.limit, limit, reason or 'not overloaded')))
+                    self.limit = limit
+                    self.condition.notify_all()
+
+    def map(self, func, param):
+        def limited(p):
+            with self.condition:
+                while self.running >= self.limit:
+                    self.condition.wait()
+                self.running += 1
+            try:
+                return func(p)
+            finally:
+                with self.condition:
+                    self.running -= 1
+                    self.condition.notify_all()
+        # one param at a time, so that no job waits behind a long one while a thread is free
+        return self.pool.map(limited, param, 1)
+
+
+def exec_command(host, command):
+    """
+    run a command on a host and return its exit status and output
+    the fabric connection to the host is used directly, without changing env
+    (unlike run and its quiet or warn_only options), so that it can be called
+    from a thread while other tasks are running
+    """
+    _, stdout, _ = connections[host].exec_command(command)
+    output = stdout.read()
+    return stdout.channel.recv_exit_status(), output
+
+
+def get_host_load(host):
+    """
+    return the load average per core, the iowait ratio (sampled over one second)
+    and the ratio of available memory of a host, see exec_command
+    """
+    _, output = exec_command(
+        host, "nproc; cat /proc/loadavg; head -1 /proc/stat; sleep 1; head -1 /proc/stat; cat /proc/meminfo")
+    lines = output.split('\n')
+    cores = int(lines[0])
+    before, after = ([int(x) for x in line.split()[1:]] for line in lines[2:4])
+    delta = [a - b for a, b in zip(after, before)]
+    meminfo = {}
+    for line in lines[4:]:
+        key, sep, value = line.partition(':')
+        if sep:
+            meminfo[key.strip()] = int(value.split()[0])
+    available = meminfo.get('MemAvailable', meminfo['MemFree'] + meminfo.get('Cached', 0))
+    return {
+        'load': float(lines[1].split()[0]) / cores,
+        # fields of the cpu line: user nice system idle iowait ...
+        'iowait': float(delta[4]) / (sum(delta) or 1),
+        'mem_available': float(available) / meminfo['MemTotal'],
+    }
 
 
 def run_once_per_role(func):